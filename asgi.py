@@ -0,0 +1,94 @@
+# asgi.py - 非同期サーバー（ASGI）モード
+# `uvicorn asgi:app` で起動すると /health と /api/scrape はイベントループ上で処理され、
+# 待機・通信中もスレッドを占有しない。その他のルートは既存のFlaskアプリに委譲する。
+import json
+import logging
+import os
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+
+import main
+
+logger = logging.getLogger('asgi')
+
+# 非同期化していないルートはFlaskで処理
+# （リクエストごとにスレッドプールで並行実行。SSEの購読中も1スレッドを占有するため余裕を持たせる）
+flask_app = WSGIMiddleware(main.app, workers=int(os.getenv('SCRAPER_WSGI_WORKERS', 32)))
+
+
+async def send_json(send, payload, status=200):
+    """JSONレスポンスを返す（FlaskのjsonifyとキーのJSON表現を揃える）"""
+    body = json.dumps(payload, sort_keys=True).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def health(scope, receive, send):
+    """ヘルスチェック（取得処理の負荷に関係なく即座に応答）"""
+    await send_json(send, main.health_payload())
+
+
+async def api_scrape(scope, receive, send):
+    """API版：単一ユーザースクレイピング（非同期）"""
+    params = parse_qs(scope['query_string'].decode('utf-8'))
+    user_id = params.get('user_id', [''])[0]
+    if not user_id:
+        return await send_json(send, {'error': 'user_id parameter is required'}, 400)
+
+    fresh = params.get('fresh', [''])[0] == '1'
+
+    # timing=1の場合は段階ごとの処理時間を付けて返す
+    if params.get('timing', [''])[0] == '1':
+        timings = {}
+        result = await main.scraper.get_profile_async(user_id, fresh=fresh, timings=timings)
+        return await send_json(send, {**result, 'timing': timings})
+
+    result = await main.scraper.get_profile_async(user_id, fresh=fresh)
+    await send_json(send, result)
+
+
+# イベントループ上で処理するルート（GETのみ）
+ASYNC_ROUTES = {
+    '/health': health,
+    '/api/scrape': api_scrape,
+}
+
+
+async def lifespan(receive, send):
+    """起動・終了イベント（終了時に非同期クライアントの接続を閉じる）"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            logger.info("✅ ASGIモードで起動しました")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if main.scraper.async_client is not None:
+                await main.scraper.async_client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    handler = ASYNC_ROUTES.get(scope['path']) if scope['type'] == 'http' and scope['method'] == 'GET' else None
+    if handler is not None:
+        return await handler(scope, receive, send)
+    await flask_app(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.getenv('PORT', 8080))
+    logger.info(f"🌐 ASGIサーバー起動: ポート{port}")
+    uvicorn.run(app, host='0.0.0.0', port=port)
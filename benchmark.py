@@ -0,0 +1,295 @@
+# benchmark.py - ローカルのTikLeap代替サーバーを使ったオフラインベンチマーク
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('benchmark')
+
+# 合成プロフィールページのサイズ（バイト）
+PAGE_SIZES = {
+    'small': 10 * 1024,
+    'medium': 200 * 1024,
+    'large': 2 * 1024 * 1024,
+}
+
+SCENARIOS = ('single', 'batch', 'api', 'scrape', 'async')
+
+
+def build_synthetic_page(user_id, size):
+    """指定サイズ程度の合成プロフィールページを生成"""
+    diamond = f"{random.randint(1, 999)}.{random.randint(0, 9)}K"
+    head = (
+        '<!DOCTYPE html><html><head><title>TikLeap</title>'
+        '<style>.profile-earning-button{font-weight:bold}</style></head><body>'
+    )
+    filler_block = '<div class="profile-card"><span class="label">filler</span>' + 'x' * 180 + '</div>'
+    filler = filler_block * max(1, size // len(filler_block))
+    # 収益要素はページの中央付近に配置
+    half = len(filler) // 2
+    body = (
+        filler[:half]
+        + f'<span class="profile-earning-button">{diamond}</span>'
+        + filler[half:]
+    )
+    return (head + f'<h1>{user_id}</h1>' + body + '</body></html>').encode()
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    """クライアントが途中で切断しても（早期終了ダウンロード）ログを出さないサーバー"""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class StandInServer:
+    """TikLeapの代わりにプロフィールページを返すローカルHTTPサーバー"""
+
+    def __init__(self, page_size='medium', pages_dir=None, latency=(0.05, 0.15),
+                 forbidden_rate=0.0, server_error_rate=0.0):
+        self.latency = latency
+        self.forbidden_rate = forbidden_rate
+        self.server_error_rate = server_error_rate
+        self.recorded_pages = self._load_recorded_pages(pages_dir)
+        self.synthetic_page = build_synthetic_page('synthetic', PAGE_SIZES[page_size])
+        self.requests_served = 0
+        self._lock = threading.Lock()
+        self._server = _QuietHTTPServer(('127.0.0.1', 0), self._make_handler())
+
+    @staticmethod
+    def _load_recorded_pages(pages_dir):
+        """保存済みのHTML（<user_id>.html）を読み込む"""
+        pages = {}
+        if pages_dir:
+            for name in os.listdir(pages_dir):
+                if name.endswith('.html'):
+                    with open(os.path.join(pages_dir, name), 'rb') as f:
+                        pages[name[:-len('.html')]] = f.read()
+        return pages
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def _make_handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # ヘッダーと本文を別々に書き込むため、Nagle＋遅延ACKによる約40msの待ちを防ぐ
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with stand_in._lock:
+                    stand_in.requests_served += 1
+
+                time.sleep(random.uniform(*stand_in.latency))
+
+                # 403・5xxを指定の割合で発生させる
+                roll = random.random()
+                if roll < stand_in.forbidden_rate:
+                    return self._send(403, b'Forbidden')
+                if roll < stand_in.forbidden_rate + stand_in.server_error_rate:
+                    return self._send(503, b'Service Unavailable')
+
+                user_id = self.path.rstrip('/').rsplit('/', 1)[-1]
+                if stand_in.recorded_pages:
+                    page = stand_in.recorded_pages.get(user_id) or random.choice(list(stand_in.recorded_pages.values()))
+                else:
+                    page = stand_in.synthetic_page
+
+                # 条件付きGETに対応（内容が同じなら304）
+                etag = '"' + hashlib.sha1(page).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    return self._send(304, b'', etag)
+                self._send(200, page, etag)
+
+            def _send(self, status, body, etag=None):
+                self.send_response(status)
+                if etag:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f"🧪 代替サーバー起動: {self.base_url}")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def percentile(values, pct):
+    """単純な最近傍法によるパーセンタイル"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_scenario(scenario, base_url, users, workers):
+    """別プロセスで1つのシナリオを実行して計測結果を返す"""
+    # ベンチマーク対象はスリープ・キャッシュなしで代替サーバーに向ける
+    os.environ['TIKLEAP_BASE_URL'] = base_url
+    os.environ['SCRAPER_CACHE_BACKEND'] = 'none'
+    os.environ['SCRAPER_CHECKPOINT_PATH'] = 'none'
+    os.environ['SCRAPER_HISTORY_PATH'] = 'none'
+    os.environ['SCRAPER_PACER'] = 'noop'
+    os.environ['SCRAPER_RETRY_BACKOFF'] = '0'
+    os.environ['SCRAPER_MAX_WORKERS'] = str(workers)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import main
+    logging.getLogger('main').setLevel(logging.WARNING)
+
+    scraper = main.scraper
+    user_ids = [f"bench_user_{i}" for i in range(users)]
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    # ユーザーごとの所要時間を記録するラッパー
+    scrape_profile = scraper.scrape_tikleap_profile
+
+    def timed_scrape(user_id, *args, **kwargs):
+        started = time.perf_counter()
+        result = scrape_profile(user_id, *args, **kwargs)
+        with lock:
+            latencies.append(time.perf_counter() - started)
+            statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        return result
+
+    scrape_profile_async = scraper.scrape_tikleap_profile_async
+
+    async def timed_scrape_async(user_id, *args, **kwargs):
+        started = time.perf_counter()
+        result = await scrape_profile_async(user_id, *args, **kwargs)
+        with lock:
+            latencies.append(time.perf_counter() - started)
+            statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        return result
+
+    async def run_async():
+        # ASGIモードと同じく1つのイベントループで全ユーザーを同時に取得
+        await asyncio.gather(*(scraper.get_profile_async(user_id, fresh=True) for user_id in user_ids))
+        await scraper.async_client.close()
+
+    scraper.scrape_tikleap_profile = timed_scrape
+    scraper.scrape_tikleap_profile_async = timed_scrape_async
+    client = main.app.test_client()
+
+    started = time.perf_counter()
+    if scenario == 'single':
+        for user_id in user_ids:
+            scraper.scrape_tikleap_profile(user_id)
+    elif scenario == 'batch':
+        scraper.scrape_multiple_users(user_ids)
+    elif scenario == 'api':
+        for user_id in user_ids:
+            client.get(f'/api/scrape?user_id={user_id}&fresh=1')
+    elif scenario == 'scrape':
+        response = client.post('/scrape', json={'user_ids': user_ids, 'fresh': True})
+        response.get_data()
+    elif scenario == 'async':
+        asyncio.run(run_async())
+    elapsed = time.perf_counter() - started
+
+    parse_stats = scraper.extractor.stats()
+    parse_seconds = sum(stats['seconds'] for stats in parse_stats.values())
+
+    return {
+        'scenario': scenario,
+        'users': users,
+        'seconds': round(elapsed, 3),
+        'users_per_sec': round(users / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+        'parse_ms_total': round(parse_seconds * 1000, 1),
+        'parse_strategies': parse_stats,
+        # Linuxではru_maxrssはKB単位
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'statuses': statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TikLeapScraperのオフラインベンチマーク')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'実行するシナリオ（カンマ区切り: {",".join(SCENARIOS)}）')
+    parser.add_argument('--users', type=int, default=50, help='シナリオごとのユーザー数')
+    parser.add_argument('--workers', type=int, default=8, help='バッチの並列ワーカー数')
+    parser.add_argument('--page-size', choices=sorted(PAGE_SIZES), default='medium', help='合成ページのサイズ')
+    parser.add_argument('--pages-dir', help='保存済みHTML（<user_id>.html）を配信するディレクトリ')
+    parser.add_argument('--latency-ms', default='50,150', help='疑似レイテンシの範囲（最小,最大ミリ秒）')
+    parser.add_argument('--forbidden-rate', type=float, default=0.0, help='403を返す割合')
+    parser.add_argument('--server-error-rate', type=float, default=0.0, help='503を返す割合')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    args = parser.parse_args()
+
+    latency_min, latency_max = (float(value) / 1000 for value in args.latency_ms.split(','))
+    server = StandInServer(
+        page_size=args.page_size,
+        pages_dir=args.pages_dir,
+        latency=(latency_min, latency_max),
+        forbidden_rate=args.forbidden_rate,
+        server_error_rate=args.server_error_rate,
+    )
+    server.start()
+
+    reports = []
+    try:
+        for scenario in args.scenarios.split(','):
+            scenario = scenario.strip()
+            if scenario not in SCENARIOS:
+                parser.error(f'unknown scenario: {scenario}')
+
+            # ピークRSSを分離するため、シナリオごとに新しいプロセスで実行
+            logger.info(f"⏱️ シナリオ実行中: {scenario}")
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                report = executor.submit(run_scenario, scenario, server.base_url, args.users, args.workers).result()
+            reports.append(report)
+    finally:
+        server.stop()
+
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+        return
+
+    print(f"{'scenario':<8} {'users/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'parse ms':>9} {'peak MB':>9}  statuses")
+    for report in reports:
+        print(
+            f"{report['scenario']:<8} {report['users_per_sec']:>9} {report['p50_ms']:>9} "
+            f"{report['p99_ms']:>9} {report['parse_ms_total']:>9} {report['peak_rss_mb']:>9}  {report['statuses']}"
+        )
+
+
+if __name__ == '__main__':
+    main()
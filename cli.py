@@ -0,0 +1,235 @@
+# cli.py - Flaskを経由しないコマンドライン一括スクレイピング
+import argparse
+import hashlib
+import logging
+import os
+import sys
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+# CLIからはウォッチリストの巡回を起動しない
+os.environ['SCRAPER_SCHEDULER'] = '0'
+
+import main
+
+logger = logging.getLogger('cli')
+
+
+def parse_shard(value):
+    """'i/N'形式のシャード指定を(i, N)に変換"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid shard: {value} (expected i/N)')
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'invalid shard: {value} (need 0 <= i < N)')
+    return index, count
+
+
+def shard_of(user_id, count):
+    """ユーザーIDのハッシュで決まるシャード番号（マシン間で一致する）"""
+    digest = hashlib.md5(user_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def iter_user_ids(stream, shard=None):
+    """入力を1行ずつ正規化・重複除去し、担当シャードのIDだけを返す"""
+    for user_id in main.iter_normalized_user_ids(stream):
+        if shard is not None and shard_of(user_id, shard[1]) != shard[0]:
+            continue
+        yield user_id
+
+
+def iter_chunks(user_ids, size):
+    chunk = []
+    for user_id in user_ids:
+        chunk.append(user_id)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _init_worker(rate_limit, log_level):
+    """ワーカープロセスの初期化（全体のレート上限をプロセス数で分割済み）"""
+    main.scraper.set_pacer(main.create_pacer(rate_limit))
+    logging.getLogger('main').setLevel(log_level)
+
+
+def _scrape_chunk(fresh, user_ids):
+    return main.scraper.scrape_multiple_users(user_ids, fresh=fresh)
+
+
+def _reextract_chunk(archive_dir, pages):
+    """アーカイブ済みページに現在の抽出チェーンを適用（ネットワークアクセスなし）"""
+    results = []
+    for user_id, digest, fetched_at in pages:
+        timestamp = datetime.fromtimestamp(fetched_at).strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            earning_value = main.scraper.extractor.extract(main.PageArchive.read_blob(archive_dir, digest))
+        except OSError as e:
+            results.append({'user_id': user_id, 'diamond': None, 'status': 'error', 'error': str(e), 'timestamp': timestamp})
+            continue
+        if earning_value:
+            results.append({'user_id': user_id, 'diamond': earning_value, 'status': 'success', 'error': None, 'timestamp': timestamp})
+        else:
+            results.append({
+                'user_id': user_id, 'diamond': None, 'status': 'not_found',
+                'error': 'Data element not found in HTML', 'timestamp': timestamp,
+            })
+    return results
+
+
+def iter_pooled(chunks, processes, task, task_args, initargs):
+    """プロセスプールでチャンクごとに処理し、入力順に結果を返す"""
+    executor = ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=get_context('spawn'),
+        initializer=_init_worker,
+        initargs=initargs,
+    )
+    pending = deque()
+    try:
+        # 入力全体を読み込まないよう、未完了チャンク数を制限
+        for chunk in chunks:
+            pending.append(executor.submit(task, *task_args, chunk))
+            if len(pending) >= processes * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_results(user_ids, processes, chunk_size, rate_limit, fresh=False, log_level=logging.WARNING):
+    """プロセスプールでチャンクごとに取得し、入力順に結果を返す"""
+    per_process_rate = rate_limit / processes if rate_limit > 0 else 0
+    return iter_pooled(
+        iter_chunks(user_ids, chunk_size), processes, _scrape_chunk, (fresh,), (per_process_rate, log_level)
+    )
+
+
+def write_results(results, output, output_format):
+    """結果を指定形式（main.EXPORT_FORMATS）でバイナリ出力先に書き出し、件数を返す"""
+    count = 0
+
+    def counted():
+        nonlocal count
+        for result in results:
+            count += 1
+            yield result
+
+    for chunk in main.scraper.export_stream(counted(), output_format):
+        output.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+    return count
+
+
+def command_scrape(args):
+    input_stream = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    if args.format == 'parquet' and main.pa is None:
+        raise SystemExit('parquet output requires pyarrow')
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+
+    try:
+        user_ids = iter_user_ids(input_stream, shard=args.shard)
+        results = iter_results(
+            user_ids,
+            processes=args.processes,
+            chunk_size=args.chunk_size,
+            rate_limit=args.rate_limit,
+            fresh=args.fresh,
+            log_level=logging.INFO if args.verbose else logging.WARNING,
+        )
+        count = write_results(results, output, args.format)
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if output is not sys.stdout.buffer:
+            output.close()
+
+    shard = f" (shard {args.shard[0]}/{args.shard[1]})" if args.shard else ''
+    logger.info(f"✅ {count}件を出力しました{shard}")
+
+
+def command_reextract(args):
+    archive = main.create_page_archive(args.archive_dir)
+    if archive is None:
+        raise SystemExit('archive directory is required (--archive-dir or SCRAPER_ARCHIVE_DIR)')
+    if args.format == 'parquet' and main.pa is None:
+        raise SystemExit('parquet output requires pyarrow')
+
+    user_ids = None
+    if args.input:
+        with open(args.input, encoding='utf-8') as f:
+            user_ids = list(main.iter_normalized_user_ids(f))
+    pages = archive.iter_pages(user_ids, all_versions=args.all_versions)
+    results = iter_pooled(
+        iter_chunks(pages, args.chunk_size), args.processes, _reextract_chunk, (archive.directory,),
+        (0, logging.INFO if args.verbose else logging.WARNING),
+    )
+
+    history = main.scraper.history if args.backfill_history else None
+    if args.backfill_history and history is None:
+        raise SystemExit('history store is disabled (SCRAPER_HISTORY_PATH=none)')
+
+    def recorded(results):
+        # 再抽出した値をページ取得時刻で履歴に記録
+        for result in results:
+            if history is not None and result['status'] != 'error':
+                history.record(result, recorded_at=main.typed_record(result)['timestamp'].timestamp())
+            yield result
+
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        count = write_results(recorded(results), output, args.format)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+
+    logger.info(f"✅ {count}件のページを再抽出しました")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='TikLeapスクレイピングCLI')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scrape = subparsers.add_parser('scrape', help='ユーザーIDリストを一括取得')
+    scrape.add_argument('--input', '-i', default='-', help='ユーザーIDファイル（1行1件、-で標準入力）')
+    scrape.add_argument('--output', '-o', default='-', help='出力先（-で標準出力）')
+    scrape.add_argument('--format', '-f', choices=sorted(main.EXPORT_FORMATS), default='ndjson', help='出力形式')
+    scrape.add_argument('--shard', type=parse_shard, help='i/N: IDのハッシュでN分割したうちi番目だけを処理')
+    scrape.add_argument('--processes', '-p', type=int, default=os.cpu_count() or 1, help='ワーカープロセス数')
+    scrape.add_argument('--chunk-size', type=int, default=50, help='1タスクあたりのユーザー数')
+    scrape.add_argument('--rate-limit', type=float, default=float(os.getenv('SCRAPER_RATE_LIMIT', 0.5)),
+                        help='このプロセス全体のリクエスト上限（requests/sec、0で無制限）')
+    scrape.add_argument('--fresh', action='store_true', help='キャッシュを使わずに取得')
+    scrape.add_argument('--verbose', '-v', action='store_true', help='ワーカーの詳細ログを表示')
+    scrape.set_defaults(handler=command_scrape)
+
+    reextract = subparsers.add_parser('reextract', help='アーカイブ済みのページから収益データを再抽出')
+    reextract.add_argument('--archive-dir', help='ページアーカイブのディレクトリ（既定はSCRAPER_ARCHIVE_DIR）')
+    reextract.add_argument('--input', '-i', help='対象ユーザーIDファイル（省略時はアーカイブ全体）')
+    reextract.add_argument('--output', '-o', default='-', help='出力先（-で標準出力）')
+    reextract.add_argument('--format', '-f', choices=sorted(main.EXPORT_FORMATS), default='ndjson', help='出力形式')
+    reextract.add_argument('--all-versions', action='store_true', help='最新だけでなく保存済みの全世代を処理')
+    reextract.add_argument('--backfill-history', action='store_true', help='再抽出した値を履歴に記録')
+    reextract.add_argument('--processes', '-p', type=int, default=os.cpu_count() or 1, help='ワーカープロセス数')
+    reextract.add_argument('--chunk-size', type=int, default=200, help='1タスクあたりのページ数')
+    reextract.add_argument('--verbose', '-v', action='store_true', help='ワーカーの詳細ログを表示')
+    reextract.set_defaults(handler=command_reextract)
+
+    return parser
+
+
+def run():
+    args = build_parser().parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    run()
@@ -1,15 +1,43 @@
 # main.py - TikLeapスクレイピング（アンチボット対策版）
 import os
+import asyncio
 import logging
 import time
 import random
 import requests
+from requests.adapters import HTTPAdapter
 import csv
+import hashlib
 import io
+import re
+import json
+import sqlite3
+import threading
+import uuid
+import heapq
+import gzip
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from bs4 import BeautifulSoup
 from flask import Flask, jsonify, request, Response, render_template_string
 
+# 非同期モード（asgi.py）はaiohttpがある場合のみ有効
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Parquet出力はpyarrowがある場合のみ有効
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 # ログ設定
 logging.basicConfig(
     level=logging.INFO,
@@ -114,6 +142,37 @@ HTML_TEMPLATE = """
             0% { transform: rotate(0deg); }
             100% { transform: rotate(360deg); }
         }
+        #progressBar {
+            width: 100%;
+            height: 18px;
+            margin-top: 10px;
+        }
+        button.cancel {
+            background-color: #e57373;
+            padding: 6px 16px;
+            font-size: 14px;
+        }
+        button.cancel:hover {
+            background-color: #d32f2f;
+        }
+        .live-table {
+            width: 100%;
+            margin-top: 20px;
+            border-collapse: collapse;
+            font-size: 13px;
+            display: none;
+        }
+        .live-table th, .live-table td {
+            border-bottom: 1px solid #eee;
+            padding: 4px 8px;
+            text-align: left;
+        }
+        .live-table tr.status-success td.status { color: green; }
+        .live-table tr.status-not_found td.status,
+        .live-table tr.status-deferred td.status { color: #b8860b; }
+        .live-table tr.status-blocked td.status,
+        .live-table tr.status-error td.status,
+        .live-table tr.status-failed td.status { color: red; }
         .test-section {
             margin-top: 30px;
             padding-top: 20px;
@@ -138,7 +197,7 @@ HTML_TEMPLATE = """
             <strong>使い方：</strong><br>
             1. ユーザーIDを1行に1つずつ入力してください<br>
             2. 「スクレイピング開始」をクリック<br>
-            3. 処理完了後、CSVファイルがダウンロードされます
+            3. 完了したユーザーから順に下の表に表示され、最後にCSVファイルがダウンロードされます
         </div>
         
         <form id="scraperForm">
@@ -147,16 +206,28 @@ HTML_TEMPLATE = """
 kururi_kore
 pukudayo24</textarea><br>
             
+            <label for="idFile"><strong>またはファイルをアップロード（.txt / .csv）：</strong></label><br>
+            <input type="file" id="idFile" accept=".txt,.csv,text/plain,text/csv"><br>
+            
             <button type="submit" id="submitBtn">🚀 スクレイピング開始（ゆっくり処理）</button>
         </form>
         
         <div id="loading">
             <div class="spinner"></div>
-            <span>処理中... 各ユーザー3-5秒待機しています</span>
+            <span id="progress">ジョブを登録しています...</span>
+            <button type="button" id="cancelBtn" class="cancel">⏹ キャンセル</button>
+            <progress id="progressBar" value="0" max="1"></progress>
         </div>
         
         <div id="result" class="result"></div>
         
+        <table id="liveTable" class="live-table">
+            <thead>
+                <tr><th>#</th><th>user_id</th><th>diamond</th><th>status</th><th>error</th><th>timestamp</th></tr>
+            </thead>
+            <tbody id="liveRows"></tbody>
+        </table>
+        
         <div class="test-section">
             <h3>🧪 単一ユーザーテスト</h3>
             <input type="text" id="testUserId" placeholder="テストするユーザーID" style="padding: 8px; width: 200px;">
@@ -166,15 +237,106 @@ pukudayo24</textarea><br>
     </div>
     
     <script>
+        const CSV_FIELDS = ['user_id', 'diamond', 'status', 'error', 'timestamp'];
+        let activeJobId = null;
+        
+        // 受信済みの結果からCSVを生成（サーバーのCSVと同じ列・クォート規則）
+        function buildCsv(rows) {
+            const escape = (value) => {
+                const text = value === null || value === undefined ? '' : String(value);
+                return /[",\\r\\n]/.test(text) ? `"${text.replace(/"/g, '""')}"` : text;
+            };
+            const lines = [CSV_FIELDS.join(',')];
+            for (const row of rows) {
+                lines.push(CSV_FIELDS.map(field => escape(row[field])).join(','));
+            }
+            return lines.join('\\r\\n') + '\\r\\n';
+        }
+        
+        // 結果は完了順に届くため、入力順の位置に行を挿入
+        function insertRow(index, result) {
+            const tr = document.createElement('tr');
+            tr.dataset.index = index;
+            tr.className = `status-${result.status}`;
+            const cells = [index + 1, ...CSV_FIELDS.map(field => result[field] ?? '')];
+            cells.forEach((value, i) => {
+                const td = document.createElement('td');
+                td.textContent = value;
+                if (CSV_FIELDS[i - 1] === 'status') {
+                    td.className = 'status';
+                }
+                tr.appendChild(td);
+            });
+            const tbody = document.getElementById('liveRows');
+            const next = Array.from(tbody.children).find(row => Number(row.dataset.index) > index);
+            tbody.insertBefore(tr, next || null);
+        }
+        
+        // ジョブの結果をSSEで受信し、表と進捗バーを更新（完了時に最終状態を返す）
+        function streamJob(job, rows) {
+            const progress = document.getElementById('progress');
+            const progressBar = document.getElementById('progressBar');
+            progressBar.max = job.total;
+            progressBar.value = 0;
+            progress.textContent = `処理中... 0/${job.total}件完了`;
+            
+            return new Promise((resolve, reject) => {
+                const events = new EventSource(`/jobs/${job.job_id}/events`);
+                
+                events.addEventListener('result', (event) => {
+                    const data = JSON.parse(event.data);
+                    // 再接続で同じ結果を受け取った場合は上書きのみ
+                    if (rows[data.index] === undefined) {
+                        insertRow(data.index, data.result);
+                    }
+                    rows[data.index] = data.result;
+                    progressBar.value = data.done;
+                    progress.textContent = `処理中... ${data.done}/${data.total}件完了（${data.result.user_id}: ${data.result.status}）`;
+                });
+                
+                events.addEventListener('done', (event) => {
+                    events.close();
+                    resolve(JSON.parse(event.data));
+                });
+                
+                events.onerror = () => {
+                    // 自動再接続できない場合のみエラーにする
+                    if (events.readyState === EventSource.CLOSED) {
+                        reject(new Error('進捗の受信が切断されました'));
+                    }
+                };
+            });
+        }
+        
+        function cancelActiveJob(useBeacon) {
+            if (!activeJobId) {
+                return;
+            }
+            const url = `/jobs/${activeJobId}/cancel`;
+            if (useBeacon) {
+                navigator.sendBeacon(url);
+            } else {
+                fetch(url, { method: 'POST' });
+            }
+            document.getElementById('progress').textContent = 'キャンセルしています...';
+        }
+        
+        document.getElementById('cancelBtn').addEventListener('click', () => cancelActiveJob(false));
+        // ページを離れた場合もサーバー側のバッチを止める
+        window.addEventListener('pagehide', () => cancelActiveJob(true));
+        
         document.getElementById('scraperForm').addEventListener('submit', async (e) => {
             e.preventDefault();
             
             const userIds = document.getElementById('userIds').value;
+            const idFile = document.getElementById('idFile').files[0];
             const submitBtn = document.getElementById('submitBtn');
             const loading = document.getElementById('loading');
+            const progress = document.getElementById('progress');
             const resultDiv = document.getElementById('result');
+            const liveTable = document.getElementById('liveTable');
             
-            if (!userIds.trim()) {
+            if (!idFile && !userIds.trim()) {
                 alert('ユーザーIDを入力してください');
                 return;
             }
@@ -182,39 +344,69 @@ pukudayo24</textarea><br>
             submitBtn.disabled = true;
             loading.style.display = 'block';
             resultDiv.style.display = 'none';
+            progress.textContent = 'ジョブを登録しています...';
+            document.getElementById('liveRows').innerHTML = '';
+            liveTable.style.display = 'table';
             
             try {
-                const response = await fetch('/scrape', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                    },
-                    body: JSON.stringify({
-                        user_ids: userIds.split('\\n').filter(id => id.trim())
+                // ジョブを登録してすぐにジョブIDを受け取る（ファイルはそのまま送信）
+                const response = idFile
+                    ? await fetch('/jobs/upload', {
+                        method: 'POST',
+                        headers: {
+                            'Content-Type': idFile.type || 'text/plain',
+                        },
+                        body: idFile
                     })
-                });
+                    : await fetch('/jobs', {
+                        method: 'POST',
+                        headers: {
+                            'Content-Type': 'application/json',
+                        },
+                        body: JSON.stringify({
+                            user_ids: userIds.split('\\n').filter(id => id.trim())
+                        })
+                    });
                 
-                if (response.ok) {
-                    const blob = await response.blob();
-                    const url = window.URL.createObjectURL(blob);
-                    const a = document.createElement('a');
-                    a.href = url;
-                    a.download = `tikleap_data_${new Date().toISOString().split('T')[0]}.csv`;
-                    document.body.appendChild(a);
-                    a.click();
-                    window.URL.revokeObjectURL(url);
-                    
-                    resultDiv.innerHTML = '<div class="success">✅ CSVファイルのダウンロードが完了しました！</div>';
-                    resultDiv.style.display = 'block';
-                } else {
+                if (!response.ok) {
                     const error = await response.json();
-                    resultDiv.innerHTML = `<div class="error">❌ エラー: ${error.error}</div>`;
-                    resultDiv.style.display = 'block';
+                    throw new Error(error.error);
+                }
+                
+                const job = await response.json();
+                activeJobId = job.job_id;
+                
+                // 結果はユーザーごとにSSEで受信（CSVは受信済みの行から生成）
+                const rows = [];
+                const status = await streamJob(job, rows);
+                activeJobId = null;
+                
+                if (status.state === 'failed') {
+                    throw new Error(status.error || 'ジョブが失敗しました');
                 }
+                
+                const blob = new Blob([buildCsv(rows.filter(row => row))], { type: 'text/csv' });
+                const url = window.URL.createObjectURL(blob);
+                const a = document.createElement('a');
+                a.href = url;
+                a.download = `tikleap_data_${new Date().toISOString().split('T')[0]}.csv`;
+                document.body.appendChild(a);
+                a.click();
+                window.URL.revokeObjectURL(url);
+                
+                const counts = Object.entries(status.status_counts)
+                    .map(([key, value]) => `${key}: ${value}`)
+                    .join(', ');
+                const message = status.state === 'cancelled'
+                    ? `⏹ キャンセルしました。完了済みの${status.done}/${status.total}件をダウンロードしました (${counts})`
+                    : `✅ CSVファイルのダウンロードが完了しました！ (${counts})`;
+                resultDiv.innerHTML = `<div class="success">${message}</div>`;
+                resultDiv.style.display = 'block';
             } catch (error) {
                 resultDiv.innerHTML = `<div class="error">❌ エラー: ${error.message}</div>`;
                 resultDiv.style.display = 'block';
             } finally {
+                activeJobId = null;
                 submitBtn.disabled = false;
                 loading.style.display = 'none';
             }
@@ -249,286 +441,2754 @@ pukudayo24</textarea><br>
 </html>
 """
 
-class TikLeapScraper:
-    def __init__(self):
-        """TikLeapスクレイピングシステム（アンチボット対策版）"""
-        # ユーザーエージェントのリスト（ランダムに選択）
-        self.user_agents = [
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/121.0',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15',
-        ]
-        
-        # セッションは毎回新しく作成
-        logger.info("✅ TikLeapScraperシステム初期化完了")
-    
-    def create_session(self):
-        """新しいセッションを作成（毎回異なるヘッダー）"""
-        session = requests.Session()
-        
-        # ランダムなユーザーエージェントを選択
-        user_agent = random.choice(self.user_agents)
-        
-        # より本物のブラウザに近いヘッダー
-        session.headers = {
-            'User-Agent': user_agent,
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'Accept-Language': 'ja-JP,ja;q=0.9,en-US;q=0.8,en;q=0.7',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'none',
-            'Sec-Fetch-User': '?1',
-            'Cache-Control': 'max-age=0',
-        }
+class SystemClock:
+    """実時間の時計（テスト用に差し替え可能）"""
+
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class TokenBucketPacer:
+    """全スレッド共通のトークンバケットによるリクエストペース制御（requests/sec）"""
+
+    def __init__(self, rate, burst=1, clock=None):
+        # rateが0以下の場合は制限なし
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock or SystemClock()
+        self._tokens = float(self.burst)
+        self._updated = self.clock.now()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """トークンを1つ予約し、送信可能になるまでの秒数を返す（待機はしない）"""
+        if not self.rate or self.rate <= 0:
+            return 0.0
         
-        return session
-    
-    def scrape_tikleap_profile(self, user_id, retry_count=3):
-        """TikLeapプロフィールページから収益データを取得（リトライ機能付き）"""
-        url = f"https://www.tikleap.com/profile/{user_id}"
+        with self._lock:
+            now = self.clock.now()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """送信枠まで待機し、待機した秒数を返す"""
+        wait_time = self.reserve()
+        self.clock.sleep(wait_time)
+        return wait_time
+
+    async def acquire_async(self):
+        """イベントループをブロックせずに送信枠まで待機"""
+        wait_time = self.reserve()
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+        return wait_time
+
+
+class NoopPacer:
+    """待機しないペース制御（テスト・ベンチマーク用）"""
+
+    rate = 0
+
+    def reserve(self):
+        return 0.0
+
+    def acquire(self):
+        return 0.0
+
+    async def acquire_async(self):
+        return 0.0
+
+
+class BackoffPolicy:
+    """Retry-Afterを考慮したジッター付き指数バックオフ"""
+
+    def __init__(self, base=2.0, cap=60.0, jitter=0.5, clock=None):
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.clock = clock or SystemClock()
+
+    def delay(self, attempt, retry_after=None):
+        """attempt回目のリトライ前に待つ秒数（上限はcap）"""
+        if self.base <= 0 and retry_after is None:
+            return 0.0
         
-        for attempt in range(retry_count):
-            try:
-                # 各試行で新しいセッションを使用
-                session = self.create_session()
-                
-                logger.info(f"🔍 スクレイピング開始 (試行 {attempt + 1}/{retry_count}): {url}")
-                
-                # より長いランダムな待機時間
-                wait_time = random.uniform(3.0, 5.0) + (attempt * 2)  # リトライごとに待機時間を増やす
-                logger.info(f"⏳ {wait_time:.1f}秒待機中...")
-                time.sleep(wait_time)
-                
-                # リクエスト送信
-                response = session.get(
-                    url, 
-                    timeout=20,
-                    allow_redirects=True,
-                    verify=True
-                )
-                
-                logger.info(f"📡 ステータスコード: {response.status_code}")
-                
-                # 403エラーの場合、リトライ
-                if response.status_code == 403:
-                    logger.warning(f"⚠️ 403 Forbidden - 試行 {attempt + 1}/{retry_count}")
-                    if attempt < retry_count - 1:
-                        continue
-                    else:
-                        return {
-                            'user_id': user_id,
-                            'diamond': None,
-                            'status': 'blocked',
-                            'error': '403 Forbidden - Access blocked by server',
-                            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        }
-                
-                response.raise_for_status()
-                
-                # HTMLパース
-                soup = BeautifulSoup(response.content, 'html.parser')
-                
-                # デバッグ: HTMLの一部を出力
-                logger.info(f"📄 HTML長さ: {len(response.content)} bytes")
-                
-                # 複数の方法でデータを探す
-                earning_value = None
-                
-                # 方法1: profile-earning-buttonクラス
-                earning_element = soup.find('span', class_='profile-earning-button')
-                if earning_element:
-                    earning_value = earning_element.get_text().strip()
-                    logger.info(f"✅ 方法1で取得: {earning_value}")
-                
-                # 方法2: 他の可能性のあるセレクター
-                if not earning_value:
-                    # profile-earningを含むクラス
-                    earning_elements = soup.find_all('span', class_=lambda x: x and 'earning' in x.lower() if x else False)
-                    if earning_elements:
-                        earning_value = earning_elements[0].get_text().strip()
-                        logger.info(f"✅ 方法2で取得: {earning_value}")
+        backoff = min(self.cap, self.base * (2 ** (attempt - 1)))
+        # 同時にリトライするワーカーが揃わないようにジッターを加える
+        backoff = backoff * (1 - self.jitter) + random.uniform(0, backoff * self.jitter)
+        if retry_after is not None:
+            backoff = max(backoff, retry_after)
+        return min(self.cap, backoff)
+
+    def wait(self, attempt, retry_after=None):
+        wait_time = self.delay(attempt, retry_after)
+        self.clock.sleep(wait_time)
+        return wait_time
+
+    async def wait_async(self, attempt, retry_after=None):
+        wait_time = self.delay(attempt, retry_after)
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+        return wait_time
+
+    @staticmethod
+    def parse_retry_after(value):
+        """Retry-Afterヘッダー（秒数またはHTTP日付）を秒数に変換"""
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, retry_at.timestamp() - time.time())
+
+
+def create_pacer(rate_limit=None, clock=None):
+    """環境変数の設定からペース制御を生成"""
+    if os.getenv('SCRAPER_PACER', 'token_bucket').lower() == 'noop':
+        return NoopPacer()
+    if rate_limit is None:
+        rate_limit = float(os.getenv('SCRAPER_RATE_LIMIT', 0.5))
+    burst = int(os.getenv('SCRAPER_RATE_BURST', 1))
+    return TokenBucketPacer(rate_limit, burst=burst, clock=clock)
+
+
+def create_backoff(clock=None):
+    """環境変数の設定からリトライのバックオフを生成"""
+    return BackoffPolicy(
+        base=float(os.getenv('SCRAPER_RETRY_BACKOFF', 2.0)),
+        cap=float(os.getenv('SCRAPER_RETRY_BACKOFF_MAX', 60.0)),
+        clock=clock,
+    )
+
+
+class MetricsRegistry:
+    """Prometheusテキスト形式で出力できるカウンター・ヒストグラム・ゲージ"""
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text):
+        self._metrics[name] = {'type': 'counter', 'help': help_text, 'values': {}}
+
+    def histogram(self, name, help_text, buckets):
+        self._metrics[name] = {'type': 'histogram', 'help': help_text, 'buckets': tuple(buckets), 'values': {}}
+
+    def gauge(self, name, help_text, callback):
+        """出力時にcallbackを呼んで値（数値または{ラベル: 値}）を取得するゲージ"""
+        self._metrics[name] = {'type': 'gauge', 'help': help_text, 'callback': callback}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        with self._lock:
+            values = self._metrics[name]['values']
+            key = self._key(labels)
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        with self._lock:
+            metric = self._metrics[name]
+            key = self._key(labels)
+            series = metric['values'].get(key)
+            if series is None:
+                series = metric['values'][key] = {'buckets': [0] * len(metric['buckets']), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(metric['buckets']):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+    def render(self):
+        """Prometheusテキスト形式で全メトリクスを出力"""
+        lines = []
+        with self._lock:
+            for name, metric in self._metrics.items():
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['type']}")
                 
-                # 方法3: データ属性を探す
-                if not earning_value:
-                    data_elements = soup.find_all(['span', 'div'], attrs={'data-earning': True})
-                    if data_elements:
-                        earning_value = data_elements[0].get_text().strip()
-                        logger.info(f"✅ 方法3で取得: {earning_value}")
+                if metric['type'] == 'counter':
+                    for key, value in metric['values'].items():
+                        lines.append(f"{name}{self._format_labels(key)} {value}")
                 
-                if earning_value:
-                    logger.info(f"✅ {user_id}: 収益データ = {earning_value}")
-                    return {
-                        'user_id': user_id,
-                        'diamond': earning_value,
-                        'status': 'success',
-                        'error': None,
-                        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    }
-                else:
-                    # HTMLの一部をログに出力してデバッグ
-                    all_spans = soup.find_all('span', class_=True)[:10]
-                    logger.warning(f"⚠️ データ要素が見つかりません。見つかったspan: {[span.get('class') for span in all_spans]}")
-                    
-                    return {
-                        'user_id': user_id,
-                        'diamond': None,
-                        'status': 'not_found',
-                        'error': 'Data element not found in HTML',
-                        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    }
+                elif metric['type'] == 'histogram':
+                    for key, series in metric['values'].items():
+                        for bound, count in zip(metric['buckets'], series['buckets']):
+                            lines.append(f"{name}_bucket{self._format_labels(key + (('le', bound),))} {count}")
+                        lines.append(f"{name}_bucket{self._format_labels(key + (('le', '+Inf'),))} {series['count']}")
+                        lines.append(f"{name}_sum{self._format_labels(key)} {series['sum']}")
+                        lines.append(f"{name}_count{self._format_labels(key)} {series['count']}")
                 
-            except requests.exceptions.HTTPError as e:
-                if '403' in str(e):
-                    logger.error(f"❌ {user_id} 403エラー (試行 {attempt + 1}/{retry_count}): {e}")
-                    if attempt < retry_count - 1:
-                        continue
-                else:
-                    logger.error(f"❌ {user_id} HTTPエラー: {e}")
-                    return {
-                        'user_id': user_id,
-                        'diamond': None,
-                        'status': 'error',
-                        'error': str(e),
-                        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    }
-            except requests.RequestException as e:
-                logger.error(f"❌ {user_id} ネットワークエラー (試行 {attempt + 1}/{retry_count}): {e}")
-                if attempt < retry_count - 1:
-                    continue
-                return {
-                    'user_id': user_id,
-                    'diamond': None,
-                    'status': 'error',
-                    'error': str(e),
-                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                }
-            except Exception as e:
-                logger.error(f"❌ {user_id} 処理エラー: {e}")
-                return {
-                    'user_id': user_id,
-                    'diamond': None,
-                    'status': 'error',
-                    'error': str(e),
-                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                }
-            finally:
-                # セッションをクローズ
-                if 'session' in locals():
-                    session.close()
-        
-        # 全てのリトライが失敗
-        return {
-            'user_id': user_id,
-            'diamond': None,
-            'status': 'failed',
-            'error': f'Failed after {retry_count} attempts',
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
-    
-    def scrape_multiple_users(self, user_ids):
-        """複数ユーザーのデータを取得"""
-        results = []
-        total = len(user_ids)
-        
-        for i, user_id in enumerate(user_ids, 1):
-            logger.info(f"📊 処理中 {i}/{total}: {user_id}")
-            result = self.scrape_tikleap_profile(user_id.strip())
-            results.append(result)
-            
-            # 最後のユーザー以外は追加の待機
-            if i < total:
-                wait_time = random.uniform(2.0, 4.0)
-                logger.info(f"⏳ 次のユーザーまで{wait_time:.1f}秒待機...")
-                time.sleep(wait_time)
-        
-        return results
-    
-    def generate_csv(self, results):
-        """結果をCSV形式で生成"""
-        output = io.StringIO()
-        writer = csv.DictWriter(
-            output,
-            fieldnames=['user_id', 'diamond', 'status', 'error', 'timestamp'],
-            quoting=csv.QUOTE_MINIMAL
-        )
-        
-        writer.writeheader()
-        for result in results:
-            writer.writerow(result)
+                elif metric['type'] == 'gauge':
+                    value = metric['callback']()
+                    if isinstance(value, dict):
+                        for label_value, gauge_value in value.items():
+                            lines.append(f"{name}{self._format_labels(label_value)} {gauge_value}")
+                    elif value is not None:
+                        lines.append(f"{name} {value}")
         
-        return output.getvalue()
+        return '\n'.join(lines) + '\n'
 
-# Flask アプリケーション
-app = Flask(__name__)
-scraper = TikLeapScraper()
 
-@app.route('/')
-def home():
-    """Webインターフェース"""
-    return render_template_string(HTML_TEMPLATE)
+# 段階ごとの処理時間のヒストグラム境界（秒）
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BATCH_BUCKETS = (1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200)
 
-@app.route('/health')
-def health_check():
-    """ヘルスチェック"""
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': datetime.now().isoformat()
-    })
 
-@app.route('/scrape', methods=['POST'])
-def scrape():
-    """スクレイピング実行とCSV返却"""
-    try:
-        data = request.json
-        user_ids = data.get('user_ids', [])
-        
-        if not user_ids:
-            return jsonify({'error': 'No user IDs provided'}), 400
-        
-        # スクレイピング実行
-        results = scraper.scrape_multiple_users(user_ids)
-        
-        # CSV生成
-        csv_data = scraper.generate_csv(results)
-        
-        # CSVファイルとして返却
-        return Response(
-            csv_data,
-            mimetype='text/csv',
-            headers={
-                'Content-Disposition': f'attachment; filename=tikleap_data_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-            }
+def create_metrics_registry():
+    """スクレイパーが記録するメトリクスを定義したレジストリを生成"""
+    registry = MetricsRegistry()
+    registry.counter('tikleap_scrape_results_total', 'Profile lookups by result status')
+    registry.counter('tikleap_scrape_retries_total', 'Retried fetch attempts')
+    registry.counter('tikleap_coalesced_requests_total', 'Lookups that shared an in-flight fetch for the same user')
+    registry.counter('tikleap_not_modified_total', 'Conditional GETs answered with 304 Not Modified')
+    registry.counter('tikleap_early_terminated_downloads_total', 'Downloads stopped once the earnings element was read')
+    registry.counter('tikleap_downloaded_bytes_total', 'Decoded response body bytes read')
+    registry.histogram(
+        'tikleap_scrape_stage_seconds',
+        'Time spent per stage (pace, backoff, connect_ttfb, download, parse, csv, total)',
+        STAGE_BUCKETS,
+    )
+    registry.histogram('tikleap_batch_duration_seconds', 'Total duration of completed batches', BATCH_BUCKETS)
+    return registry
+
+
+# 本文を読み込む単位（バイト）
+DOWNLOAD_CHUNK_SIZE = 16 * 1024
+
+# バッチの結果を待つ間にキャンセルを確認する間隔（秒）
+CANCEL_POLL_INTERVAL = 0.1
+
+# キャッシュ対象とするステータス（一時的なエラーはキャッシュしない）
+CACHEABLE_STATUSES = ('success', 'not_found')
+
+
+class MemoryResultCache:
+    """プロセス内のTTL付きLRUキャッシュ"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """有効期限内の結果を返す（なければNone）"""
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._data[user_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[1])
+
+    def set(self, user_id, result):
+        with self._lock:
+            self._data[user_id] = (time.time() + self.ttl, dict(result))
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+class SQLiteResultCache:
+    """SQLiteによる永続TTLキャッシュ（再起動後も有効）"""
+
+    def __init__(self, path, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS result_cache ('
+            'user_id TEXT PRIMARY KEY, result TEXT NOT NULL, '
+            'expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
         )
-        
-    except Exception as e:
-        logger.error(f"❌ エラー: {e}")
-        return jsonify({'error': str(e)}), 500
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_result_cache_accessed ON result_cache (accessed_at)')
+        self._conn.commit()
 
-@app.route('/api/scrape', methods=['GET'])
-def api_scrape():
-    """API版：単一ユーザースクレイピング"""
+    def get(self, user_id):
+        """有効期限内の結果を返す（なければNone）"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT result, expires_at FROM result_cache WHERE user_id = ?', (user_id,)
+            ).fetchone()
+            if row is None or row[1] < now:
+                if row is not None:
+                    self._conn.execute('DELETE FROM result_cache WHERE user_id = ?', (user_id,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE result_cache SET accessed_at = ? WHERE user_id = ?', (now, user_id))
+            self._conn.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, user_id, result):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO result_cache (user_id, result, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (user_id, json.dumps(result, ensure_ascii=False), now + self.ttl, now)
+            )
+            # サイズ上限を超えた分は最終アクセスが古いものから削除
+            self._conn.execute(
+                'DELETE FROM result_cache WHERE user_id IN ('
+                'SELECT user_id FROM result_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_size,)
+            )
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute('SELECT COUNT(*) FROM result_cache').fetchone()[0]
+            return {'backend': 'sqlite', 'size': size, 'hits': self.hits, 'misses': self.misses}
+
+
+def create_result_cache():
+    """環境変数の設定から結果キャッシュを生成（none指定時はNone）"""
+    backend = os.getenv('SCRAPER_CACHE_BACKEND', 'memory').lower()
+    ttl = float(os.getenv('SCRAPER_CACHE_TTL', 600))
+    max_size = int(os.getenv('SCRAPER_CACHE_SIZE', 10000))
+    
+    if backend == 'none':
+        return None
+    if backend == 'sqlite':
+        path = os.getenv('SCRAPER_CACHE_PATH', 'tikleap_cache.sqlite3')
+        logger.info(f"🗄️ SQLiteキャッシュ使用: {path} (TTL {ttl:.0f}秒)")
+        return SQLiteResultCache(path, ttl, max_size)
+    return MemoryResultCache(ttl, max_size)
+
+
+class CheckpointStore:
+    """バッチのユーザーごとの結果を追記するSQLiteチェックポイント"""
+
+    def __init__(self, path, window):
+        # windowより古い結果は再開時に再取得する
+        self.window = window
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS batch_checkpoints ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, batch_id TEXT NOT NULL, user_id TEXT NOT NULL, '
+            'status TEXT NOT NULL, result TEXT NOT NULL, completed_at REAL NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_batch_checkpoints_batch '
+            'ON batch_checkpoints (batch_id, completed_at)'
+        )
+        # 期限切れの記録を整理
+        self._conn.execute('DELETE FROM batch_checkpoints WHERE completed_at < ?', (time.time() - self.window,))
+        self._conn.commit()
+
+    def append(self, batch_id, result):
+        """1ユーザー分の結果を追記"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO batch_checkpoints (batch_id, user_id, status, result, completed_at) VALUES (?, ?, ?, ?, ?)',
+                (batch_id, result['user_id'], result['status'], json.dumps(result, ensure_ascii=False), time.time())
+            )
+            self._conn.commit()
+
+    def load_completed(self, batch_id):
+        """有効期間内に完了したユーザーの最新結果を{user_id: result}で返す"""
+        placeholders = ','.join('?' * len(CACHEABLE_STATUSES))
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT user_id, result FROM batch_checkpoints '
+                f'WHERE batch_id = ? AND completed_at >= ? AND status IN ({placeholders}) ORDER BY id',
+                (batch_id, time.time() - self.window, *CACHEABLE_STATUSES)
+            ).fetchall()
+        return {user_id: json.loads(result) for user_id, result in rows}
+
+
+def create_checkpoint_store():
+    """環境変数の設定からチェックポイントを生成（none指定時はNone）"""
+    path = os.getenv('SCRAPER_CHECKPOINT_PATH', 'tikleap_checkpoints.sqlite3')
+    if path.lower() == 'none':
+        return None
+    window = float(os.getenv('SCRAPER_CHECKPOINT_WINDOW', 86400))
+    return CheckpointStore(path, window)
+
+
+# 収益表示の単位（12.3K → 12300、1.2万 → 12000）
+DIAMOND_SUFFIXES = {'': 1, 'K': 1_000, 'M': 1_000_000, 'B': 1_000_000_000, '万': 10_000, '億': 100_000_000}
+# 数値の後の単位（K/M/Bは英字が続かない場合のみ。数値に直接続くそれ以外の英字は未知の単位として取り出し、
+# 空白の後の語や「ダイヤ」などはラベルとして無視する）
+DIAMOND_PATTERN = re.compile(r'([0-9][0-9,]*(?:\.[0-9]+)?)(\s*[KMB](?![A-Za-z])|[万億]|[A-Za-z]*)', re.IGNORECASE)
+
+
+def parse_diamond(value):
+    """diamond文字列（例: '12.3K', '1,234', '2M', '1.2万'）を数値に変換（解析できなければNone）"""
+    if not value:
+        return None
+    match = DIAMOND_PATTERN.search(value)
+    if not match:
+        return None
+    multiplier = DIAMOND_SUFFIXES.get(match.group(2).strip().upper())
+    if multiplier is None:
+        # '3months'のような未知の単位は数値として扱わない
+        return None
+    number = float(match.group(1).replace(',', ''))
+    return number * multiplier
+
+
+# 出力形式ごとの(MIMEタイプ, 拡張子)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', '.csv'),
+    'csv.gz': ('application/gzip', '.csv.gz'),
+    'ndjson': ('application/x-ndjson', '.ndjson'),
+    'parquet': ('application/vnd.apache.parquet', '.parquet'),
+}
+
+def typed_record(result):
+    """結果を型付きの値（数値のdiamond・datetimeのtimestamp）に変換"""
+    try:
+        timestamp = datetime.strptime(result['timestamp'], '%Y-%m-%d %H:%M:%S')
+    except (KeyError, TypeError, ValueError):
+        timestamp = None
+    return {
+        'user_id': result['user_id'],
+        'diamond': result.get('diamond'),
+        'diamond_value': parse_diamond(result.get('diamond')),
+        'status': result['status'],
+        'error': result.get('error'),
+        'timestamp': timestamp,
+    }
+
+
+def gzip_stream(chunks, level=6, sync_flush=False):
+    """文字列/バイト列のストリームを逐次gzip圧縮して返す
+    
+    sync_flush=Trueの場合はチャンクごとに圧縮済みデータを送り出す（ライブ配信用。圧縮率は少し下がる）
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        compressed = compressor.compress(chunk)
+        if sync_flush:
+            compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class _ChunkSink:
+    """書き込まれたバイト列を溜めておき、取り出した分は破棄する出力先（Parquetの逐次出力用）"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def export_schema():
+    """Parquet出力のスキーマ"""
+    return pa.schema([
+        ('user_id', pa.string()),
+        ('diamond', pa.string()),
+        ('diamond_value', pa.float64()),
+        # statusはカテゴリ値なので辞書型で保存
+        ('status', pa.dictionary(pa.int8(), pa.string())),
+        ('error', pa.string()),
+        ('timestamp', pa.timestamp('s')),
+    ])
+
+
+class HistoryStore:
+    """diamond値の時系列をSQLiteに保存し、ユーザー・期間で検索"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS diamond_history ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, status TEXT NOT NULL, '
+            'diamond TEXT, diamond_value REAL, recorded_at REAL NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_diamond_history_user_time ON diamond_history (user_id, recorded_at)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_diamond_history_time ON diamond_history (recorded_at)')
+        self._conn.commit()
+
+    def record(self, result, recorded_at=None):
+        """スクレイピング結果を1件保存（recorded_at指定時はその時刻で記録）"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO diamond_history (user_id, status, diamond, diamond_value, recorded_at) VALUES (?, ?, ?, ?, ?)',
+                (result['user_id'], result['status'], result['diamond'], parse_diamond(result['diamond']),
+                 recorded_at or time.time())
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def _row_to_dict(row):
+        record = dict(row)
+        record['recorded_at'] = datetime.fromtimestamp(record['recorded_at']).isoformat()
+        return record
+
+    def user_history(self, user_id, since=None, until=None, limit=1000):
+        """1ユーザーの履歴（新しい順）"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT user_id, status, diamond, diamond_value, recorded_at FROM diamond_history '
+                'WHERE user_id = ? AND recorded_at >= ? AND recorded_at <= ? '
+                'ORDER BY recorded_at DESC LIMIT ?',
+                (user_id, since or 0, until or time.time(), limit)
+            ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def latest(self, user_ids):
+        """複数ユーザーの最新の成功値を1クエリで取得"""
+        if not user_ids:
+            return []
+        placeholders = ','.join('?' * len(user_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT user_id, status, diamond, diamond_value, MAX(recorded_at) AS recorded_at '
+                f'FROM diamond_history WHERE status = ? AND user_id IN ({placeholders}) GROUP BY user_id',
+                ('success', *user_ids)
+            ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def top_movers(self, window, limit=10):
+        """期間内の最初と最後の値の差が大きいユーザー上位N件"""
+        with self._lock:
+            rows = self._conn.execute(
+                'WITH recent AS ('
+                '  SELECT user_id, diamond_value, recorded_at FROM diamond_history'
+                '  WHERE status = ? AND diamond_value IS NOT NULL AND recorded_at >= ?'
+                '), firsts AS ('
+                '  SELECT user_id, diamond_value AS first_value, MIN(recorded_at) AS first_at FROM recent GROUP BY user_id'
+                '), lasts AS ('
+                '  SELECT user_id, diamond_value AS last_value, MAX(recorded_at) AS last_at FROM recent GROUP BY user_id'
+                ') '
+                'SELECT f.user_id, first_value, last_value, last_value - first_value AS change, first_at, last_at '
+                'FROM firsts f JOIN lasts l ON f.user_id = l.user_id '
+                'ORDER BY ABS(last_value - first_value) DESC LIMIT ?',
+                ('success', time.time() - window, limit)
+            ).fetchall()
+        
+        movers = []
+        for row in rows:
+            mover = dict(row)
+            mover['first_at'] = datetime.fromtimestamp(mover['first_at']).isoformat()
+            mover['last_at'] = datetime.fromtimestamp(mover['last_at']).isoformat()
+            movers.append(mover)
+        return movers
+
+
+def create_history_store():
+    """環境変数の設定から履歴ストアを生成（none指定時はNone）"""
+    path = os.getenv('SCRAPER_HISTORY_PATH', 'tikleap_history.sqlite3')
+    if path.lower() == 'none':
+        return None
+    return HistoryStore(path)
+
+
+class PageArchive:
+    """取得したプロフィールHTMLをgzip圧縮・内容アドレス（sha256）で保存し、SQLiteで索引"""
+
+    def __init__(self, directory, max_age, max_versions, max_bytes, prune_every=500):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_versions = max_versions
+        self.max_bytes = max_bytes
+        self.prune_every = prune_every
+        self._stores_since_prune = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, digest TEXT NOT NULL, '
+            'fetched_at REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_pages_user_time ON pages (user_id, fetched_at)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_pages_digest ON pages (digest)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS blobs ('
+            'digest TEXT PRIMARY KEY, size INTEGER NOT NULL, stored_size INTEGER NOT NULL)'
+        )
+        self._conn.commit()
+        self.prune()
+
+    @staticmethod
+    def blob_path(directory, digest):
+        """本文ファイルのパス（索引を開かずに読み込めるよう静的に決まる）"""
+        return os.path.join(directory, 'objects', digest[:2], f'{digest}.html.gz')
+
+    @staticmethod
+    def read_blob(directory, digest):
+        with open(PageArchive.blob_path(directory, digest), 'rb') as f:
+            return gzip.decompress(f.read())
+
+    def store(self, user_id, content, fetched_at=None):
+        """ページを保存してダイジェストを返す（同じ内容の本文は1回だけ書き込む）"""
+        digest = hashlib.sha256(content).hexdigest()
+        with self._lock:
+            exists = self._conn.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if not exists:
+                path = self.blob_path(self.directory, digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                compressed = gzip.compress(content, compresslevel=6)
+                # 書きかけのファイルを読まないよう一時ファイルから置き換える
+                temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(compressed)
+                os.replace(temp_path, path)
+                self._conn.execute(
+                    'INSERT INTO blobs (digest, size, stored_size) VALUES (?, ?, ?)',
+                    (digest, len(content), len(compressed))
+                )
+            self._conn.execute(
+                'INSERT INTO pages (user_id, digest, fetched_at) VALUES (?, ?, ?)',
+                (user_id, digest, fetched_at or time.time())
+            )
+            self._conn.commit()
+            self._stores_since_prune += 1
+            prune = self._stores_since_prune >= self.prune_every
+        if prune:
+            self.prune()
+        return digest
+
+    def load(self, digest):
+        """ダイジェストからページ本文を読み込む"""
+        return self.read_blob(self.directory, digest)
+
+    def iter_pages(self, user_ids=None, all_versions=False):
+        """保存済みページの(user_id, digest, fetched_at)を返す（既定ではユーザーごとの最新のみ）"""
+        query = 'SELECT user_id, digest, fetched_at FROM pages'
+        params = []
+        if user_ids:
+            query += f" WHERE user_id IN ({','.join('?' * len(user_ids))})"
+            params.extend(user_ids)
+        if not all_versions:
+            query = (
+                f'SELECT user_id, digest, MAX(fetched_at) AS fetched_at FROM ({query}) GROUP BY user_id'
+            )
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY user_id, fetched_at', params).fetchall()
+        for row in rows:
+            yield row
+
+    def prune(self):
+        """保持期間・ユーザーごとの世代数・総サイズの上限を超えた記録を削除"""
+        with self._lock:
+            self._stores_since_prune = 0
+            self._conn.execute('DELETE FROM pages WHERE fetched_at < ?', (time.time() - self.max_age,))
+            self._conn.execute(
+                'DELETE FROM pages WHERE id IN ('
+                'SELECT id FROM (SELECT id, ROW_NUMBER() OVER '
+                '(PARTITION BY user_id ORDER BY fetched_at DESC, id DESC) AS version FROM pages) '
+                'WHERE version > ?)',
+                (self.max_versions,)
+            )
+            
+            # 総サイズが上限を超える場合は古い記録から削除
+            total = self._conn.execute('SELECT COALESCE(SUM(stored_size), 0) FROM blobs').fetchone()[0]
+            while total > self.max_bytes:
+                oldest = self._conn.execute('SELECT id, digest FROM pages ORDER BY fetched_at, id LIMIT 1').fetchone()
+                if oldest is None:
+                    break
+                self._conn.execute('DELETE FROM pages WHERE id = ?', (oldest[0],))
+                if not self._conn.execute('SELECT 1 FROM pages WHERE digest = ?', (oldest[1],)).fetchone():
+                    total -= self._delete_blob(oldest[1])
+            
+            # どのページからも参照されなくなった本文を削除
+            orphans = self._conn.execute(
+                'SELECT digest FROM blobs WHERE digest NOT IN (SELECT digest FROM pages)'
+            ).fetchall()
+            for (digest,) in orphans:
+                self._delete_blob(digest)
+            self._conn.commit()
+
+    def _delete_blob(self, digest):
+        """本文ファイルと索引を削除し、削除したサイズを返す"""
+        row = self._conn.execute('SELECT stored_size FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        self._conn.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+        try:
+            os.remove(self.blob_path(self.directory, digest))
+        except FileNotFoundError:
+            pass
+        return row[0] if row else 0
+
+    def stats(self):
+        with self._lock:
+            pages = self._conn.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+            blobs, size, stored_size = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM blobs'
+            ).fetchone()
+        return {'pages': pages, 'blobs': blobs, 'bytes': size, 'stored_bytes': stored_size}
+
+
+def create_page_archive(directory=None):
+    """環境変数の設定からページアーカイブを生成（未設定時は無効でNone）"""
+    directory = directory or os.getenv('SCRAPER_ARCHIVE_DIR')
+    if not directory or directory.lower() == 'none':
+        return None
+    max_age = float(os.getenv('SCRAPER_ARCHIVE_MAX_AGE', 30 * 86400))
+    max_versions = int(os.getenv('SCRAPER_ARCHIVE_VERSIONS', 5))
+    max_bytes = int(os.getenv('SCRAPER_ARCHIVE_MAX_BYTES', 1024 * 1024 * 1024))
+    logger.info(f"🗃️ ページアーカイブ使用: {directory}")
+    return PageArchive(directory, max_age, max_versions, max_bytes)
+
+
+# プロフィールURLからユーザーIDを取り出すパターン
+PROFILE_URL_PATTERN = re.compile(r'tikleap\.com/profile/([^/?#\s]+)', re.IGNORECASE)
+
+
+def normalize_user_id(raw):
+    """入力1行をユーザーIDに正規化（@除去・プロフィールURL・CSVの1列目に対応、無効ならNone）"""
+    value = raw.strip().lstrip('\ufeff')
+    if not value or value.startswith('#'):
+        return None
+    
+    match = PROFILE_URL_PATTERN.search(value)
+    if match:
+        value = match.group(1)
+    else:
+        # CSVの場合は1列目をIDとみなす
+        value = value.split(',', 1)[0].strip().strip('"').strip()
+    
+    value = value.lstrip('@')
+    # CSVのヘッダー行は読み飛ばす
+    if not value or value.lower() in ('user_id', 'userid', 'id'):
+        return None
+    return value
+
+
+def iter_normalized_user_ids(lines):
+    """行のイテラブルを1行ずつ正規化し、重複を除いて返す"""
+    seen = set()
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        user_id = normalize_user_id(line)
+        if user_id is None or user_id in seen:
+            continue
+        seen.add(user_id)
+        yield user_id
+
+
+def batch_id_for(user_ids):
+    """ユーザーIDリストから決まるバッチID（同じリストの再投入で再開できる）"""
+    digest = hashlib.sha256('\n'.join(user_id.strip() for user_id in user_ids).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+class ValidatorStore:
+    """ユーザーごとのETag/Last-Modifiedと前回の結果を保持するLRU"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is not None:
+                self._data.move_to_end(user_id)
+            return entry
+
+    def set(self, user_id, etag, last_modified, result):
+        with self._lock:
+            self._data[user_id] = {'etag': etag, 'last_modified': last_modified, 'result': dict(result)}
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+class SingleFlight:
+    """同じキーの処理が同時に走らないようにし、進行中の結果を共有"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """(結果, 他の呼び出しの結果を共有したか) を返す"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        
+        if not leader:
+            return future.result(), True
+        
+        try:
+            result = fn(*args, **kwargs)
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight:
+    """SingleFlightのasyncio版（同じイベントループ内の同時呼び出しをまとめる）"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        """(結果, 他の呼び出しの結果を共有したか) を返す"""
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+        
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn(*args, **kwargs)
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            # 待っている呼び出しがなくても「未取得の例外」警告を出さない
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
+
+
+# エラー率の計算で失敗とみなすステータス
+FAILURE_STATUSES = ('blocked', 'error', 'failed')
+
+
+class AdaptiveController:
+    """直近のエラー率に応じて同時実行数と送信レートを増減（AIMD）し、サーキットブレーカーで遮断"""
+
+    def __init__(self, max_limit, pacer, clock=None, window=None, min_samples=None,
+                 decrease_threshold=None, open_threshold=None, cooldown=None):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.pacer = pacer
+        self.base_rate = pacer.rate
+        self.clock = clock or SystemClock()
+        # 直近window件の結果からエラー率を計算
+        self.window = window or int(os.getenv('SCRAPER_BREAKER_WINDOW', 50))
+        self.min_samples = min_samples or int(os.getenv('SCRAPER_BREAKER_MIN_SAMPLES', 10))
+        self.decrease_threshold = decrease_threshold or float(os.getenv('SCRAPER_AIMD_DECREASE_THRESHOLD', 0.2))
+        self.open_threshold = open_threshold or float(os.getenv('SCRAPER_BREAKER_THRESHOLD', 0.5))
+        self.cooldown = cooldown or float(os.getenv('SCRAPER_BREAKER_COOLDOWN', 60))
+        self.state = 'closed'
+        self._outcomes = deque(maxlen=self.window)
+        self._in_flight = 0
+        self._increase_credit = 0.0
+        self._last_decrease = 0.0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._condition = threading.Condition()
+        # acquire_asyncで待機中の(イベントループ, Future)
+        self._async_waiters = set()
+
+    def _notify_waiters(self):
+        """空きや状態の変化を待機中のスレッド・コルーチンに知らせる（ロック保持中に呼ぶ）"""
+        self._condition.notify_all()
+        for loop, waiter in self._async_waiters:
+            loop.call_soon_threadsafe(self._wake, waiter)
+        self._async_waiters.clear()
+
+    @staticmethod
+    def _wake(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def _refresh_state(self):
+        """クールダウン経過後はハーフオープンにして試行を1件だけ許可"""
+        if self.state == 'open' and self.clock.now() - self._opened_at >= self.cooldown:
+            self.state = 'half_open'
+            self._probe_in_flight = False
+            logger.info("🔌 サーキットをハーフオープンにして再試行します")
+
+    def is_open(self):
+        with self._condition:
+            self._refresh_state()
+            return self.state == 'open'
+
+    def _try_acquire(self):
+        """実行枠の確保を試みる（True: 確保, False: サーキットが開いている, None: 空き待ち）"""
+        self._refresh_state()
+        if self.state == 'open':
+            return False
+        if self.state == 'half_open':
+            # 試行中は結果が出るまで待つ（成功すれば閉じ、失敗すれば再び開く）
+            if self._probe_in_flight:
+                return None
+            self._probe_in_flight = True
+            self._in_flight += 1
+            return True
+        if self._in_flight < self.limit:
+            self._in_flight += 1
+            return True
+        return None
+
+    def acquire(self):
+        """実行枠を確保（サーキットが開いていればFalse）"""
+        with self._condition:
+            while True:
+                acquired = self._try_acquire()
+                if acquired is not None:
+                    return acquired
+                self._condition.wait(timeout=1.0)
+
+    async def acquire_async(self):
+        """acquireの非同期版（空きを待つ間もイベントループを止めない）"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                acquired = self._try_acquire()
+                if acquired is not None:
+                    return acquired
+                waiter = (loop, loop.create_future())
+                self._async_waiters.add(waiter)
+            try:
+                # クールダウンの経過は通知されないため、acquireと同じく定期的に再確認
+                await asyncio.wait_for(waiter[1], timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._condition:
+                    self._async_waiters.discard(waiter)
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._notify_waiters()
+
+    def record(self, status):
+        """結果を記録し、エラー率に応じて同時実行数・レート・サーキット状態を更新"""
+        failed = status in FAILURE_STATUSES
+        with self._condition:
+            if status == 'deferred':
+                # 延期された結果はエラー率に含めない
+                self._probe_in_flight = False
+                self._notify_waiters()
+                return
+            
+            if self.state == 'half_open':
+                self._probe_in_flight = False
+                if failed:
+                    self._open()
+                else:
+                    self.state = 'closed'
+                    self._outcomes.clear()
+                    logger.info("✅ 試行が成功したためサーキットを閉じます")
+                self._notify_waiters()
+                return
+            
+            self._outcomes.append(failed)
+            error_rate = sum(self._outcomes) / len(self._outcomes)
+            enough_samples = len(self._outcomes) >= self.min_samples
+            
+            if enough_samples and error_rate >= self.open_threshold:
+                self._open()
+            elif failed and enough_samples and error_rate >= self.decrease_threshold:
+                # 乗算的減少（同じエラーの波で何度も減らさないよう間隔を空ける）
+                now = self.clock.now()
+                if now - self._last_decrease >= 1.0:
+                    self._last_decrease = now
+                    self._set_limit(max(1, self.limit // 2))
+            elif not failed and self.limit < self.max_limit:
+                # 加算的増加（同時実行数ぶん成功するごとに+1）
+                self._increase_credit += 1 / self.limit
+                if self._increase_credit >= 1:
+                    self._increase_credit = 0.0
+                    self._set_limit(self.limit + 1)
+            self._notify_waiters()
+
+    def _open(self):
+        self.state = 'open'
+        self._opened_at = self.clock.now()
+        self._set_limit(1)
+        logger.warning(f"🚫 エラー率上昇のためサーキットを開きます（{self.cooldown:.0f}秒後に再試行）")
+
+    def _set_limit(self, limit):
+        if limit != self.limit:
+            logger.info(f"🎚️ 同時実行数を調整: {self.limit} → {limit}")
+        self.limit = limit
+        # 送信レートも同時実行数に比例させる
+        if self.base_rate and self.base_rate > 0:
+            self.pacer.rate = self.base_rate * limit / self.max_limit
+
+    def set_pacer(self, pacer):
+        """制御対象のペース制御を差し替え（現在の同時実行数に応じたレートを引き継ぐ）"""
+        with self._condition:
+            self.pacer = pacer
+            self.base_rate = pacer.rate
+            self._set_limit(self.limit)
+
+    def stats(self):
+        with self._condition:
+            self._refresh_state()
+            return {
+                'state': self.state,
+                'limit': self.limit,
+                'max_limit': self.max_limit,
+                'in_flight': self._in_flight,
+                'error_rate': round(sum(self._outcomes) / len(self._outcomes), 4) if self._outcomes else 0.0,
+                'rate': self.pacer.rate,
+            }
+
+
+# 抽出戦略が結果を判定できなかったことを示す値（次の戦略にフォールバック）
+UNDETERMINED = object()
+
+# ページの先頭部分だけでは判定に必要な範囲が揃っていないことを示す値（高速パス内部用）
+INCOMPLETE = object()
+
+
+class EarningExtractor:
+    """収益データ抽出戦略の基底クラス"""
+
+    name = 'base'
+
+    def extract(self, content):
+        """抽出した値を返す（見つからない場合はNone、判定できない場合はUNDETERMINED）"""
+        raise NotImplementedError
+
+
+class RegexEarningExtractor(EarningExtractor):
+    """ツリーを構築せず、最初のprofile-earning-button要素だけを探す高速パス"""
+
+    name = 'regex'
+
+    EARNING_PATTERN = re.compile(rb'earning', re.IGNORECASE)
+    BUTTON_PATTERN = re.compile(rb'profile-earning-button')
+    TAG_PATTERN = re.compile(rb'<span\s[^<>]*>', re.IGNORECASE)
+    # 開始タグの属性を先頭から1つずつ読む（引用符内の文字列を属性と取り違えない）
+    ATTR_PATTERN = re.compile(rb'[\s/]*([^\s/>"\'=][^\s/>=]*)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'=<>`]+)))?')
+    CLOSE_PATTERN = re.compile(rb'</span[\s>]')
+    # html.parserが中身をタグとして解釈しない領域（開始, 終了）
+    RAW_REGIONS = ((b'<script', b'</script'), (b'<style', b'</style'), (b'<!--', b'-->'))
+
+    def extract(self, content):
+        # 'earning'を含まないページは3つの方法のいずれでも見つからない
+        if not self.EARNING_PATTERN.search(content):
+            return None
+        
+        lowered = None
+        for match in self.BUTTON_PATTERN.finditer(content):
+            pos = match.start()
+            if lowered is None:
+                lowered = content.lower()
+            if self._in_raw_region(lowered, pos):
+                continue
+            # 最初の候補で判定できなければフルパースに任せる
+            value = self._extract_span_text(content, lowered, pos)
+            return UNDETERMINED if value is INCOMPLETE else value
+        
+        return UNDETERMINED
+
+    def _in_raw_region(self, lowered, pos):
+        for start_marker, end_marker in self.RAW_REGIONS:
+            if lowered.rfind(start_marker, 0, pos) > lowered.rfind(end_marker, 0, pos):
+                return True
+        return False
+
+    def _extract_span_text(self, content, lowered, pos):
+        tag_start = content.rfind(b'<', 0, pos)
+        tag_end = content.find(b'>', pos)
+        if tag_start == -1:
+            return UNDETERMINED
+        if tag_end == -1:
+            return INCOMPLETE
+        
+        tag = content[tag_start:tag_end + 1]
+        if not self.TAG_PATTERN.fullmatch(tag):
+            return UNDETERMINED
+        
+        # class属性が重複する場合はhtml.parserと同じく最後の値が有効になるためフルパースに任せる
+        class_values = self._class_values(tag)
+        if class_values is None or len(class_values) != 1:
+            return UNDETERMINED
+        if b'profile-earning-button' not in class_values[0].split():
+            return UNDETERMINED
+        
+        # 中身がテキストのみの場合だけ高速パスで確定（</spanxなど別のタグは除く）
+        text_end = content.find(b'<', tag_end + 1)
+        if text_end == -1 or len(content) - text_end < len(b'</span>'):
+            return INCOMPLETE
+        if not self.CLOSE_PATTERN.match(lowered, text_end):
+            return UNDETERMINED
+        
+        # 文字参照や非ASCII文字を含む場合は文字コード判定ごとフルパースに任せる
+        text = content[tag_end + 1:text_end]
+        if b'&' in text or not text.isascii():
+            return UNDETERMINED
+        
+        value = text.decode('ascii').strip()
+        return value or UNDETERMINED
+
+    def _class_values(self, tag):
+        """開始タグのclass属性の値をすべて返す（属性を読み切れない場合はNone）"""
+        attrs = tag[len(b'<span'):-1]
+        values = []
+        pos = 0
+        while True:
+            match = self.ATTR_PATTERN.match(attrs, pos)
+            if not match:
+                break
+            if match.group(1).lower() == b'class':
+                values.append(next((group for group in match.groups()[1:] if group is not None), b''))
+            pos = match.end()
+        if attrs[pos:].strip(b' \t\r\n\f/'):
+            return None
+        return values
+
+    def extract_prefix(self, content, start=0):
+        """ページの先頭部分だけで判定し、(判定, 次回の走査開始位置) を返す
+        
+        判定は値・UNDETERMINED（高速パスでは確定できない）・None（続きが必要）のいずれか。
+        """
+        lowered = None
+        for match in self.BUTTON_PATTERN.finditer(content, start):
+            pos = match.start()
+            if lowered is None:
+                lowered = content.lower()
+            # スクリプト等の中の候補は続きを読んでも判定が変わらないので、次回は走査しない
+            if self._in_raw_region(lowered, pos):
+                start = match.end()
+                continue
+            # 最初の候補の判定は、その範囲が揃った時点で以降のデータに依存しない
+            value = self._extract_span_text(content, lowered, pos)
+            return (None if value is INCOMPLETE else value), pos
+        # チャンクの境界をまたぐ候補を見逃さないよう末尾から再開
+        return None, max(start, len(content) - len(b'profile-earning-button') + 1)
+
+
+class SoupEarningExtractor(EarningExtractor):
+    """BeautifulSoupでページ全体をパースする従来の3段階抽出（フォールバック）"""
+
+    name = 'soup'
+
+    def extract(self, content):
+        soup = BeautifulSoup(content, 'html.parser')
+        
+        # 複数の方法でデータを探す
+        earning_value = None
+        
+        # 方法1: profile-earning-buttonクラス
+        earning_element = soup.find('span', class_='profile-earning-button')
+        if earning_element:
+            earning_value = earning_element.get_text().strip()
+            logger.info(f"✅ 方法1で取得: {earning_value}")
+        
+        # 方法2: 他の可能性のあるセレクター
+        if not earning_value:
+            # profile-earningを含むクラス
+            earning_elements = soup.find_all('span', class_=lambda x: x and 'earning' in x.lower() if x else False)
+            if earning_elements:
+                earning_value = earning_elements[0].get_text().strip()
+                logger.info(f"✅ 方法2で取得: {earning_value}")
+        
+        # 方法3: データ属性を探す
+        if not earning_value:
+            data_elements = soup.find_all(['span', 'div'], attrs={'data-earning': True})
+            if data_elements:
+                earning_value = data_elements[0].get_text().strip()
+                logger.info(f"✅ 方法3で取得: {earning_value}")
+        
+        if not earning_value:
+            # HTMLの一部をログに出力してデバッグ
+            all_spans = soup.find_all('span', class_=True)[:10]
+            logger.warning(f"⚠️ データ要素が見つかりません。見つかったspan: {[span.get('class') for span in all_spans]}")
+            return None
+        
+        return earning_value
+
+
+class ExtractorChain:
+    """抽出戦略を順に試し、戦略ごとの処理時間を記録"""
+
+    def __init__(self, extractors):
+        self.extractors = extractors
+        self._stats = {extractor.name: {'calls': 0, 'decided': 0, 'seconds': 0.0} for extractor in extractors}
+        self._lock = threading.Lock()
+
+    def extract(self, content):
+        """最初に判定できた戦略の結果を返す（見つからない場合はNone）"""
+        for extractor in self.extractors:
+            started = time.perf_counter()
+            value = extractor.extract(content)
+            elapsed = time.perf_counter() - started
+            
+            decided = value is not UNDETERMINED
+            with self._lock:
+                stats = self._stats[extractor.name]
+                stats['calls'] += 1
+                stats['seconds'] += elapsed
+                if decided:
+                    stats['decided'] += 1
+            
+            if decided:
+                logger.info(f"🧩 抽出戦略 {extractor.name}: {elapsed * 1000:.1f}ms")
+                return value
+        
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(stats, seconds=round(stats['seconds'], 6)) for name, stats in self._stats.items()}
+
+
+class BodyReader:
+    """本文を上限サイズまで読み込み、ストリーミング時は収益要素が揃った時点で終了を判定"""
+
+    def __init__(self, max_bytes, fast_extractor, early_stop):
+        self.max_bytes = max_bytes
+        self.fast_extractor = fast_extractor
+        self.early_stop = early_stop
+        self.buffer = bytearray()
+        self.early_terminated = False
+        self.truncated = False
+        # 判定済みの候補は再走査せず、高速パスで確定できないと分かった後は走査自体をやめる
+        self._scan_pos = 0
+        self._prefix_undetermined = False
+
+    def feed(self, chunk):
+        """チャンクを追加し、読み込みを打ち切るべきならTrueを返す"""
+        self.buffer.extend(chunk)
+        
+        if len(self.buffer) >= self.max_bytes:
+            logger.warning(f"⚠️ 本文が上限{self.max_bytes}バイトに達したため読み込みを打ち切ります")
+            del self.buffer[self.max_bytes:]
+            self.truncated = True
+            return True
+        
+        if self.early_stop and not self._prefix_undetermined:
+            value, self._scan_pos = self.fast_extractor.extract_prefix(self.buffer, self._scan_pos)
+            if value is UNDETERMINED:
+                self._prefix_undetermined = True
+            elif value is not None:
+                logger.info(f"✂️ 収益要素を検出したため{len(self.buffer)}バイトで読み込みを終了")
+                self.early_terminated = True
+                return True
+        return False
+    
+    @property
+    def complete(self):
+        """本文を最後まで読み込んだか（早期終了・上限での打ち切り時はFalse）"""
+        return not (self.early_terminated or self.truncated)
+
+
+class AsyncResponse:
+    """aiohttpのレスポンスをrequestsと同じ属性（status_code/headers/raise_for_status）で扱う"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.status_code = raw.status
+        self.headers = raw.headers
+
+    def raise_for_status(self):
+        self.raw.raise_for_status()
+
+
+class TikLeapScraper:
+    def __init__(self, max_workers=None, rate_limit=None, cache=None, pool_size=None, keep_alive=None,
+                 base_url=None, pacer=None, backoff=None, clock=None, checkpoints=None, history=None,
+                 archive=None):
+        """TikLeapスクレイピングシステム（アンチボット対策版）"""
+        # 取得先のベースURL（ベンチマーク用のローカルサーバーにも向けられる）
+        self.base_url = (base_url or os.getenv('TIKLEAP_BASE_URL', 'https://www.tikleap.com')).rstrip('/')
+        
+        # Prometheus形式のメトリクス
+        self.metrics = create_metrics_registry()
+        
+        # 並列ワーカー数（環境変数で変更可能）
+        self.max_workers = max_workers or int(os.getenv('SCRAPER_MAX_WORKERS', 4))
+        
+        # 送信ペースとリトライ待機（時計は差し替え可能）
+        self.clock = clock or SystemClock()
+        self.pacer = pacer or create_pacer(rate_limit, clock=self.clock)
+        self.backoff = backoff or create_backoff(clock=self.clock)
+        
+        # 結果キャッシュ（未指定の場合は環境変数から生成）
+        self.cache = cache if cache is not None else create_result_cache()
+        
+        # 同じユーザーへの同時リクエストを1回の取得にまとめる
+        self.inflight = SingleFlight()
+        self.async_inflight = AsyncSingleFlight()
+        
+        # エラー率に応じた同時実行数・レート制御とサーキットブレーカー
+        self.controller = AdaptiveController(self.max_workers, self.pacer, clock=self.clock)
+        
+        # バッチのチェックポイント（未指定の場合は環境変数から生成）
+        self.checkpoints = checkpoints if checkpoints is not None else create_checkpoint_store()
+        
+        # diamond値の履歴（未指定の場合は環境変数から生成）
+        self.history = history if history is not None else create_history_store()
+        
+        # 取得したHTMLのアーカイブ（抽出処理の修正後にオフラインで再抽出するため）
+        self.archive = archive if archive is not None else create_page_archive()
+        
+        # ユーザーエージェントのリスト（ランダムに選択）
+        self.user_agents = [
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
+            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/121.0',
+            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15',
+        ]
+        
+        # 接続プールの設定（環境変数で変更可能）
+        self.pool_size = pool_size or int(os.getenv('SCRAPER_POOL_SIZE', 10))
+        if keep_alive is None:
+            keep_alive = os.getenv('SCRAPER_KEEP_ALIVE', '1') != '0'
+        self.keep_alive = keep_alive
+        
+        # 収益データ抽出（高速パスで判定できない場合はフルパース）
+        self.fast_extractor = RegexEarningExtractor()
+        self.extractor = ExtractorChain([self.fast_extractor, SoupEarningExtractor()])
+        
+        # 条件付きGET用の検証子（0で無効）
+        validator_size = int(os.getenv('SCRAPER_VALIDATOR_CACHE_SIZE', 10000))
+        self.validators = ValidatorStore(validator_size) if validator_size > 0 else None
+        
+        # ダウンロード設定：ストリーミング時は収益要素を見つけた時点で読み込みを打ち切る
+        self.stream_download = os.getenv('SCRAPER_STREAM_DOWNLOAD', '0') == '1'
+        self.max_body_bytes = int(os.getenv('SCRAPER_MAX_BODY_BYTES', 5 * 1024 * 1024))
+        
+        # セッションは全ユーザー・リトライ・ルートで共有（接続を再利用）
+        self.session = self.create_session()
+        # 非同期モードのクライアントは最初に使うイベントループ上で作成
+        self.async_client = None
+        self._async_client_loop = None
+        self.metrics.gauge(
+            'tikleap_connection_reuse_ratio',
+            'Share of requests served on a reused pooled connection',
+            lambda: self.pool_stats()['connection_reuse_ratio'],
+        )
+        self.metrics.gauge(
+            'tikleap_concurrency_limit',
+            'Current adaptive concurrency limit',
+            lambda: self.controller.limit,
+        )
+        self.metrics.gauge(
+            'tikleap_circuit_open',
+            'Whether the circuit breaker is open (1) or not (0)',
+            lambda: int(self.controller.is_open()),
+        )
+        
+        logger.info("✅ TikLeapScraperシステム初期化完了")
+    
+    def create_session(self):
+        """接続プール付きの共有セッションを作成"""
+        session = requests.Session()
+        
+        # スレッド間で共有する接続プール
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        
+        session.headers = self.browser_headers()
+        
+        return session
+    
+    def browser_headers(self):
+        """より本物のブラウザに近いヘッダー（User-Agentはリクエストごとに選択）"""
+        return {
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+            'Accept-Language': 'ja-JP,ja;q=0.9,en-US;q=0.8,en;q=0.7',
+            'Accept-Encoding': 'gzip, deflate, br',
+            'DNT': '1',
+            'Connection': 'keep-alive' if self.keep_alive else 'close',
+            'Upgrade-Insecure-Requests': '1',
+            'Sec-Fetch-Dest': 'document',
+            'Sec-Fetch-Mode': 'navigate',
+            'Sec-Fetch-Site': 'none',
+            'Sec-Fetch-User': '?1',
+            'Cache-Control': 'max-age=0',
+        }
+    
+    def create_async_client(self):
+        """非同期モード用の接続プール付きクライアントを作成（イベントループ上で呼ぶこと）"""
+        if aiohttp is None:
+            raise RuntimeError('Async mode requires aiohttp')
+        connector = aiohttp.TCPConnector(limit=self.pool_size, force_close=not self.keep_alive)
+        return aiohttp.ClientSession(
+            headers=self.browser_headers(),
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=20),
+        )
+    
+    def _get_async_client(self):
+        loop = asyncio.get_running_loop()
+        if self._async_client_loop is not loop:
+            self.async_client = self.create_async_client()
+            self._async_client_loop = loop
+        return self.async_client
+    
+    def _conditional_headers(self, user_id):
+        """前回の検証子があれば条件付きGETのヘッダーを返す"""
+        headers = self.request_headers()
+        entry = self.validators.get(user_id) if self.validators is not None else None
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+    
+    def _remember_validators(self, user_id, response, result):
+        """ETag/Last-Modifiedがあれば次回の条件付きGETのために保存"""
+        if self.validators is None:
+            return
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            self.validators.set(user_id, etag, last_modified, result)
+    
+    def _download(self, response):
+        """本文を読み込む（上限サイズで打ち切り、ストリーミング時は収益要素が揃った時点で終了）
+        
+        戻り値は(本文, 最後まで読み込んだか)
+        """
+        reader = self._body_reader(response)
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if reader.feed(chunk):
+                response.close()
+                break
+        return self._finish_download(reader)
+    
+    async def _download_async(self, response):
+        """_downloadの非同期版（aiohttpのレスポンス）"""
+        reader = self._body_reader(response)
+        async for chunk in response.raw.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            if reader.feed(chunk):
+                break
+        return self._finish_download(reader)
+    
+    def _body_reader(self, response):
+        early_stop = self.stream_download and response.status_code == 200
+        return BodyReader(self.max_body_bytes, self.fast_extractor, early_stop)
+    
+    def _finish_download(self, reader):
+        if reader.early_terminated:
+            self.metrics.inc('tikleap_early_terminated_downloads_total')
+        self.metrics.inc('tikleap_downloaded_bytes_total', value=len(reader.buffer))
+        return bytes(reader.buffer), reader.complete
+    
+    def profile_url(self, user_id):
+        """プロフィールページのURL"""
+        return f"{self.base_url}/profile/{user_id}"
+    
+    def set_pacer(self, pacer):
+        """ペース制御を差し替え（AIMDによるレート調整も新しいペース制御に向ける）"""
+        self.pacer = pacer
+        self.controller.set_pacer(pacer)
+    
+    def request_headers(self):
+        """リクエストごとのヘッダー（ランダムなユーザーエージェント）"""
+        return {'User-Agent': random.choice(self.user_agents)}
+    
+    def pool_stats(self):
+        """接続プールの統計（新規接続数とリクエスト数から再利用率を算出）"""
+        connections = 0
+        requests_sent = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+        
+        reuse_ratio = 1 - connections / requests_sent if requests_sent else 0.0
+        return {
+            'pool_size': self.pool_size,
+            'connections_opened': connections,
+            'requests_sent': requests_sent,
+            'connection_reuse_ratio': round(reuse_ratio, 4),
+        }
+    
+    def scrape_tikleap_profile(self, user_id, retry_count=3, timings=None, cancel_event=None):
+        """TikLeapプロフィールページから収益データを取得（リトライ機能付き、cancel_eventがセットされたら送信しない）"""
+        stages = {}
+        started = time.perf_counter()
+        
+        # サーキットが開いている間は取得せずに延期
+        if not self.controller.acquire():
+            result = self._deferred_result(user_id)
+        else:
+            result = None
+            try:
+                result = self._scrape_with_retries(user_id, retry_count, stages, cancel_event)
+            finally:
+                self.controller.release()
+                # 例外・キャンセルで結果がない場合も中立の結果を記録し、ハーフオープンの試行枠を解放する
+                self.controller.record(result['status'] if result is not None else 'deferred')
+        stages['total'] = time.perf_counter() - started
+        
+        # ステータス別件数と段階ごとの処理時間を記録
+        self.metrics.inc('tikleap_scrape_results_total', {'status': result['status']})
+        for stage, seconds in stages.items():
+            self.metrics.observe('tikleap_scrape_stage_seconds', seconds, {'stage': stage})
+        
+        if self.history is not None and result['status'] != 'deferred':
+            try:
+                self.history.record(result)
+            except sqlite3.Error as e:
+                logger.error(f"❌ 履歴の保存に失敗: {e}")
+        
+        if timings is not None:
+            timings.update({stage: round(seconds, 4) for stage, seconds in stages.items()})
+        return result
+    
+    def _deferred_result(self, user_id):
+        logger.warning(f"⏸️ {user_id}: サーキットが開いているため延期")
+        return {
+            'user_id': user_id,
+            'diamond': None,
+            'status': 'deferred',
+            'error': 'Circuit breaker open - request deferred',
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+    
+    def _cancelled_result(self, user_id):
+        logger.info(f"🛑 {user_id}: バッチが打ち切られたため取得しません")
+        return {
+            'user_id': user_id,
+            'diamond': None,
+            'status': 'deferred',
+            'error': 'Batch cancelled - request not sent',
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+    
+    def _handle_response(self, user_id, response, content, complete, attempt, retry_count, add_stage):
+        """ダウンロード済みのレスポンスを結果に変換（リトライすべき場合はNone）"""
+        logger.info(f"📡 ステータスコード: {response.status_code}")
+        
+        # 429/503は一時的なエラーとしてリトライ
+        if response.status_code in (429, 503) and attempt < retry_count - 1:
+            logger.warning(f"⚠️ {response.status_code} - 試行 {attempt + 1}/{retry_count}")
+            return None
+        
+        # 403エラーの場合、リトライ
+        if response.status_code == 403:
+            logger.warning(f"⚠️ 403 Forbidden - 試行 {attempt + 1}/{retry_count}")
+            if attempt < retry_count - 1:
+                return None
+            else:
+                return {
+                    'user_id': user_id,
+                    'diamond': None,
+                    'status': 'blocked',
+                    'error': '403 Forbidden - Access blocked by server',
+                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                }
+        
+        # 304の場合は前回の結果を再利用
+        if response.status_code == 304:
+            entry = self.validators.get(user_id) if self.validators is not None else None
+            if entry is not None:
+                logger.info(f"♻️ {user_id}: 304 Not Modified - 前回の結果を再利用")
+                self.metrics.inc('tikleap_not_modified_total')
+                return dict(entry['result'], timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        
+        response.raise_for_status()
+        
+        # デバッグ: HTMLの一部を出力
+        logger.info(f"📄 HTML長さ: {len(content)} bytes")
+        
+        # 途中で読み込みを終えた本文は再抽出に使えないため保存しない
+        if self.archive is not None and not complete:
+            logger.info(f"🗃️ {user_id}: 本文が途中までのためアーカイブへの保存をスキップ")
+        elif self.archive is not None:
+            try:
+                self.archive.store(user_id, content)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"⚠️ {user_id}: アーカイブへの保存に失敗: {e}")
+        
+        # 収益データを抽出（高速パス → BeautifulSoupの順）
+        stage_started = time.perf_counter()
+        earning_value = self.extractor.extract(content)
+        add_stage('parse', time.perf_counter() - stage_started)
+        
+        if earning_value:
+            logger.info(f"✅ {user_id}: 収益データ = {earning_value}")
+            result = {
+                'user_id': user_id,
+                'diamond': earning_value,
+                'status': 'success',
+                'error': None,
+                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+        else:
+            result = {
+                'user_id': user_id,
+                'diamond': None,
+                'status': 'not_found',
+                'error': 'Data element not found in HTML',
+                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+        
+        self._remember_validators(user_id, response, result)
+        return result
+    
+    def _scrape_with_retries(self, user_id, retry_count, stages, cancel_event=None):
+        """リトライ込みの取得処理（各段階の所要時間をstagesに加算）"""
+        url = self.profile_url(user_id)
+        
+        def add_stage(stage, seconds):
+            stages[stage] = stages.get(stage, 0.0) + seconds
+        
+        retry_after = None
+        
+        for attempt in range(retry_count):
+            try:
+                if cancel_event is not None and cancel_event.is_set():
+                    return self._cancelled_result(user_id)
+                logger.info(f"🔍 スクレイピング開始 (試行 {attempt + 1}/{retry_count}): {url}")
+                
+                # リトライ時は指数バックオフ（Retry-Afterがあればそれ以上）で待機
+                if attempt > 0:
+                    # 他のユーザーの失敗でサーキットが開いた場合はリトライしない
+                    if self.controller.is_open():
+                        return self._deferred_result(user_id)
+                    self.metrics.inc('tikleap_scrape_retries_total')
+                    backoff = self.backoff.wait(attempt, retry_after)
+                    retry_after = None
+                    add_stage('backoff', backoff)
+                    if backoff > 0:
+                        logger.info(f"⏳ リトライ前に{backoff:.1f}秒待機しました")
+                
+                # グローバルなレート制限に従って送信枠を待つ
+                wait_time = self.pacer.acquire()
+                add_stage('pace', wait_time)
+                if wait_time > 0:
+                    logger.info(f"⏳ レート制限により{wait_time:.1f}秒待機しました")
+                
+                # 待機中にバッチが打ち切られた場合は送信しない
+                if cancel_event is not None and cancel_event.is_set():
+                    return self._cancelled_result(user_id)
+                
+                # リクエスト送信（ヘッダー受信までを接続・TTFBとして計測）
+                stage_started = time.perf_counter()
+                response = self.session.get(
+                    url, 
+                    headers=self._conditional_headers(user_id),
+                    timeout=20,
+                    allow_redirects=True,
+                    verify=True,
+                    stream=True
+                )
+                add_stage('connect_ttfb', time.perf_counter() - stage_started)
+                
+                # 本文のダウンロード
+                stage_started = time.perf_counter()
+                content, complete = self._download(response)
+                add_stage('download', time.perf_counter() - stage_started)
+                
+                # サーバーから待機時間の指定があれば次のリトライで従う
+                retry_after = self.backoff.parse_retry_after(response.headers.get('Retry-After'))
+                
+                result = self._handle_response(user_id, response, content, complete, attempt, retry_count, add_stage)
+                if result is None:
+                    continue
+                return result
+                
+            except requests.exceptions.HTTPError as e:
+                if '403' in str(e):
+                    logger.error(f"❌ {user_id} 403エラー (試行 {attempt + 1}/{retry_count}): {e}")
+                    if attempt < retry_count - 1:
+                        continue
+                else:
+                    logger.error(f"❌ {user_id} HTTPエラー: {e}")
+                    return {
+                        'user_id': user_id,
+                        'diamond': None,
+                        'status': 'error',
+                        'error': str(e),
+                        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    }
+            except requests.RequestException as e:
+                logger.error(f"❌ {user_id} ネットワークエラー (試行 {attempt + 1}/{retry_count}): {e}")
+                if attempt < retry_count - 1:
+                    continue
+                return {
+                    'user_id': user_id,
+                    'diamond': None,
+                    'status': 'error',
+                    'error': str(e),
+                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                }
+            except Exception as e:
+                logger.error(f"❌ {user_id} 処理エラー: {e}")
+                return {
+                    'user_id': user_id,
+                    'diamond': None,
+                    'status': 'error',
+                    'error': str(e),
+                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                }
+        
+        # 全てのリトライが失敗
+        return {
+            'user_id': user_id,
+            'diamond': None,
+            'status': 'failed',
+            'error': f'Failed after {retry_count} attempts',
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+    
+    async def scrape_tikleap_profile_async(self, user_id, retry_count=3, timings=None):
+        """scrape_tikleap_profileの非同期版（待機・通信中はイベントループを止めない）"""
+        stages = {}
+        started = time.perf_counter()
+        
+        # サーキットが開いている間は取得せずに延期
+        if not await self.controller.acquire_async():
+            result = self._deferred_result(user_id)
+        else:
+            result = None
+            try:
+                result = await self._scrape_with_retries_async(user_id, retry_count, stages)
+            finally:
+                self.controller.release()
+                # 例外・キャンセルで結果がない場合も中立の結果を記録し、ハーフオープンの試行枠を解放する
+                self.controller.record(result['status'] if result is not None else 'deferred')
+        stages['total'] = time.perf_counter() - started
+        
+        self.metrics.inc('tikleap_scrape_results_total', {'status': result['status']})
+        for stage, seconds in stages.items():
+            self.metrics.observe('tikleap_scrape_stage_seconds', seconds, {'stage': stage})
+        
+        if self.history is not None and result['status'] != 'deferred':
+            try:
+                await asyncio.to_thread(self.history.record, result)
+            except sqlite3.Error as e:
+                logger.error(f"❌ 履歴の保存に失敗: {e}")
+        
+        if timings is not None:
+            timings.update({stage: round(seconds, 4) for stage, seconds in stages.items()})
+        return result
+    
+    async def _scrape_with_retries_async(self, user_id, retry_count, stages):
+        """_scrape_with_retriesの非同期版（aiohttpで取得し、解析・保存はスレッドで実行）"""
+        url = self.profile_url(user_id)
+        client = self._get_async_client()
+        
+        def add_stage(stage, seconds):
+            stages[stage] = stages.get(stage, 0.0) + seconds
+        
+        retry_after = None
+        
+        for attempt in range(retry_count):
+            try:
+                logger.info(f"🔍 スクレイピング開始 (試行 {attempt + 1}/{retry_count}): {url}")
+                
+                if attempt > 0:
+                    if self.controller.is_open():
+                        return self._deferred_result(user_id)
+                    self.metrics.inc('tikleap_scrape_retries_total')
+                    backoff = await self.backoff.wait_async(attempt, retry_after)
+                    retry_after = None
+                    add_stage('backoff', backoff)
+                    if backoff > 0:
+                        logger.info(f"⏳ リトライ前に{backoff:.1f}秒待機しました")
+                
+                wait_time = await self.pacer.acquire_async()
+                add_stage('pace', wait_time)
+                if wait_time > 0:
+                    logger.info(f"⏳ レート制限により{wait_time:.1f}秒待機しました")
+                
+                stage_started = time.perf_counter()
+                async with client.get(url, headers=self._conditional_headers(user_id)) as raw_response:
+                    response = AsyncResponse(raw_response)
+                    add_stage('connect_ttfb', time.perf_counter() - stage_started)
+                    
+                    stage_started = time.perf_counter()
+                    content, complete = await self._download_async(response)
+                    add_stage('download', time.perf_counter() - stage_started)
+                
+                retry_after = self.backoff.parse_retry_after(response.headers.get('Retry-After'))
+                
+                # 抽出・アーカイブ保存はCPU/ディスク処理なのでスレッドに逃がす
+                result = await asyncio.to_thread(
+                    self._handle_response, user_id, response, content, complete, attempt, retry_count, add_stage
+                )
+                if result is None:
+                    continue
+                return result
+                
+            except aiohttp.ClientResponseError as e:
+                logger.error(f"❌ {user_id} HTTPエラー: {e}")
+                return {
+                    'user_id': user_id,
+                    'diamond': None,
+                    'status': 'error',
+                    'error': str(e),
+                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                }
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"❌ {user_id} ネットワークエラー (試行 {attempt + 1}/{retry_count}): {e}")
+                if attempt < retry_count - 1:
+                    continue
+                return {
+                    'user_id': user_id,
+                    'diamond': None,
+                    'status': 'error',
+                    'error': str(e),
+                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                }
+            except Exception as e:
+                logger.error(f"❌ {user_id} 処理エラー: {e}")
+                return {
+                    'user_id': user_id,
+                    'diamond': None,
+                    'status': 'error',
+                    'error': str(e),
+                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                }
+        
+        return {
+            'user_id': user_id,
+            'diamond': None,
+            'status': 'failed',
+            'error': f'Failed after {retry_count} attempts',
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+    
+    async def get_profile_async(self, user_id, fresh=False, timings=None):
+        """get_profileの非同期版（キャッシュの読み書きはスレッドで実行）"""
+        if self.cache is not None and not fresh:
+            started = time.perf_counter()
+            cached = await asyncio.to_thread(self.cache.get, user_id)
+            if cached is not None:
+                logger.info(f"⚡ キャッシュヒット: {user_id}")
+                if timings is not None:
+                    timings['cache'] = round(time.perf_counter() - started, 4)
+                return cached
+        
+        started = time.perf_counter()
+        result, shared = await self.async_inflight.do(
+            user_id, self.scrape_tikleap_profile_async, user_id, timings=timings
+        )
+        if shared:
+            logger.info(f"🔗 進行中の取得結果を共有: {user_id}")
+            self.metrics.inc('tikleap_coalesced_requests_total')
+            if timings is not None:
+                timings['coalesced'] = round(time.perf_counter() - started, 4)
+            return dict(result)
+        
+        if self.cache is not None and result['status'] in CACHEABLE_STATUSES:
+            await asyncio.to_thread(self.cache.set, user_id, result)
+        return result
+    
+    def get_profile(self, user_id, fresh=False, timings=None, cancel_event=None):
+        """キャッシュを考慮してプロフィールを取得（fresh=Trueでキャッシュを無視）"""
+        if self.cache is not None and not fresh:
+            started = time.perf_counter()
+            cached = self.cache.get(user_id)
+            if cached is not None:
+                logger.info(f"⚡ キャッシュヒット: {user_id}")
+                if timings is not None:
+                    timings['cache'] = round(time.perf_counter() - started, 4)
+                return cached
+        
+        started = time.perf_counter()
+        result, shared = self.inflight.do(
+            user_id, self.scrape_tikleap_profile, user_id, timings=timings, cancel_event=cancel_event
+        )
+        if shared:
+            # 進行中の取得に相乗りした場合は結果のコピーを返す
+            logger.info(f"🔗 進行中の取得結果を共有: {user_id}")
+            self.metrics.inc('tikleap_coalesced_requests_total')
+            if timings is not None:
+                timings['coalesced'] = round(time.perf_counter() - started, 4)
+            return dict(result)
+        
+        if self.cache is not None and result['status'] in CACHEABLE_STATUSES:
+            self.cache.set(user_id, result)
+        return result
+    
+    def _fetch_and_checkpoint(self, user_id, fresh, batch_id, stop):
+        """1ユーザーを取得し、完了した時点でチェックポイントに追記（stopがセット済みなら取得しない）"""
+        if stop.is_set():
+            return self._cancelled_result(user_id)
+        result = self.get_profile(user_id, fresh, cancel_event=stop)
+        if batch_id is not None and self.checkpoints is not None:
+            # 保存に失敗しても再開時に取り直すだけなので、バッチ自体は続行
+            try:
+                self.checkpoints.append(batch_id, result)
+            except sqlite3.Error as e:
+                logger.error(f"❌ チェックポイントの保存に失敗: {user_id}: {e}")
+        return result
+    
+    def iter_scrape_results(self, user_ids, max_workers=None, fresh=False, batch_id=None, cancel_event=None):
+        """複数ユーザーを並列で取得し、入力順に結果を返すジェネレーター"""
+        for _, result in self._iter_indexed_results(user_ids, max_workers, fresh, batch_id, True, cancel_event):
+            yield result
+    
+    def iter_scrape_results_as_completed(self, user_ids, max_workers=None, fresh=False, batch_id=None,
+                                         cancel_event=None):
+        """複数ユーザーを並列で取得し、完了した順に(入力順の番号, 結果)を返すジェネレーター
+        
+        遅いユーザーがいても後続の結果を待たせない（ジョブの進捗配信用）
+        """
+        return self._iter_indexed_results(user_ids, max_workers, fresh, batch_id, False, cancel_event)
+    
+    def _iter_indexed_results(self, user_ids, max_workers, fresh, batch_id, ordered, cancel_event):
+        workers = max_workers or self.max_workers
+        # 同時に保持する未完了タスクの上限（メモリをバッチサイズに依存させない）
+        window = workers * 2
+        
+        # 再投入されたバッチは有効期間内に完了済みのユーザーを飛ばす
+        completed = {}
+        if batch_id is not None and self.checkpoints is not None and not fresh:
+            completed = self.checkpoints.load_completed(batch_id)
+            if completed:
+                logger.info(f"♻️ チェックポイントから再開: {batch_id} ({len(completed)}件完了済み)")
+        
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scrape')
+        # 打ち切り（キャンセル・クライアントの切断）を実行中のワーカーに伝え、待機明けの送信を止める
+        stop = cancel_event if cancel_event is not None else threading.Event()
+        # 入力順の番号 → 未返却のタスク（挿入順＝入力順）
+        pending = OrderedDict()
+        # バッチ内で重複したユーザーIDは1回だけ取得して結果を使い回す
+        futures_by_user = {}
+        done = 0
+        started = time.perf_counter()
+        
+        try:
+            for index, user_id in enumerate(user_ids):
+                user_id = user_id.strip()
+                future = futures_by_user.get(user_id)
+                if future is None:
+                    if user_id in completed:
+                        future = Future()
+                        future.set_result(completed[user_id])
+                    else:
+                        future = executor.submit(self._fetch_and_checkpoint, user_id, fresh, batch_id, stop)
+                    futures_by_user[user_id] = future
+                pending[index] = future
+                if len(pending) >= window:
+                    finished = self._pop_finished(pending, ordered, cancel_event)
+                    if finished is None:
+                        return
+                    for position, result in finished:
+                        done += 1
+                        logger.info(f"📊 完了 {done}件目: {result['user_id']} ({result['status']})")
+                        yield position, result
+            
+            while pending:
+                finished = self._pop_finished(pending, ordered, cancel_event)
+                if finished is None:
+                    return
+                for position, result in finished:
+                    done += 1
+                    logger.info(f"📊 完了 {done}件目: {result['user_id']} ({result['status']})")
+                    yield position, result
+            
+            self.metrics.observe('tikleap_batch_duration_seconds', time.perf_counter() - started)
+        finally:
+            # 途中で打ち切られた場合は未着手のタスクを破棄し、実行中のタスクには送信しないよう伝える
+            if pending:
+                stop.set()
+            for future in pending.values():
+                future.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    @staticmethod
+    def _pop_finished(pending, ordered, cancel_event):
+        """未返却のタスクから返せる結果を取り出す（入力順なら先頭1件、完了順なら完了済みすべて）
+        
+        待機中にcancel_eventがセットされた場合はNoneを返す
+        """
+        waiting = [next(iter(pending.values()))] if ordered else set(pending.values())
+        timeout = CANCEL_POLL_INTERVAL if cancel_event is not None else None
+        while not wait(waiting, timeout=timeout, return_when=FIRST_COMPLETED).done:
+            if cancel_event.is_set():
+                return None
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        
+        if ordered:
+            index, future = pending.popitem(last=False)
+            return [(index, dict(future.result()))]
+        
+        finished = [(index, future) for index, future in pending.items() if future.done()]
+        for index, _ in finished:
+            del pending[index]
+        return [(index, dict(future.result())) for index, future in finished]
+    
+    def scrape_multiple_users(self, user_ids, max_workers=None, fresh=False, batch_id=None):
+        """複数ユーザーのデータを取得（並列・入力順を維持）"""
+        logger.info(f"📊 バッチ開始: {len(user_ids)}件 (ワーカー数 {max_workers or self.max_workers})")
+        return list(self.iter_scrape_results(user_ids, max_workers=max_workers, fresh=fresh, batch_id=batch_id))
+    
+    def generate_csv_stream(self, results):
+        """結果を1行ずつCSV文字列として返すジェネレーター（ヘッダーから順に）"""
+        output = io.StringIO()
+        writer = csv.DictWriter(
+            output,
+            fieldnames=['user_id', 'diamond', 'status', 'error', 'timestamp'],
+            quoting=csv.QUOTE_MINIMAL
+        )
+        
+        writer.writeheader()
+        yield output.getvalue()
+        
+        # CSV書き込みに費やした時間のみを計測（結果の待ち時間は含めない）
+        csv_seconds = 0.0
+        for result in results:
+            stage_started = time.perf_counter()
+            # バッファを使い回してメモリ使用量を一定に保つ
+            output.seek(0)
+            output.truncate()
+            writer.writerow(result)
+            row = output.getvalue()
+            csv_seconds += time.perf_counter() - stage_started
+            yield row
+        
+        self.metrics.observe('tikleap_scrape_stage_seconds', csv_seconds, {'stage': 'csv'})
+    
+    def generate_csv(self, results):
+        """結果をCSV形式で生成"""
+        return ''.join(self.generate_csv_stream(results))
+    
+    def generate_ndjson_stream(self, results):
+        """結果を型付きのJSON Lines（diamond_value・ISO形式のtimestamp）として1行ずつ返す"""
+        for result in results:
+            record = typed_record(result)
+            if record['timestamp'] is not None:
+                record['timestamp'] = record['timestamp'].isoformat()
+            yield json.dumps(record, ensure_ascii=False) + '\n'
+    
+    def generate_parquet_stream(self, results, row_group_size=None):
+        """結果を行グループ単位でParquetに書き出し、書けた分から順に返す"""
+        if pa is None:
+            raise RuntimeError('Parquet export requires pyarrow')
+        
+        row_group_size = row_group_size or int(os.getenv('SCRAPER_EXPORT_ROW_GROUP', 10000))
+        schema = export_schema()
+        sink = _ChunkSink()
+        writer = pq.ParquetWriter(sink, schema, compression='zstd')
+        
+        def write_rows(rows):
+            columns = {name: [row[name] for row in rows] for name in schema.names}
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+        
+        rows = []
+        for result in results:
+            rows.append(typed_record(result))
+            if len(rows) >= row_group_size:
+                write_rows(rows)
+                rows = []
+                yield sink.drain()
+        if rows:
+            write_rows(rows)
+        writer.close()
+        yield sink.drain()
+    
+    def export_stream(self, results, export_format='csv', live=False):
+        """指定形式（EXPORT_FORMATSのキー）で結果を逐次出力（liveは取得しながら配信する場合）"""
+        if export_format == 'csv':
+            return self.generate_csv_stream(results)
+        if export_format == 'csv.gz':
+            # 配信中は行ごとに送り出し、圧縮器に溜めたまま待たせない
+            return gzip_stream(self.generate_csv_stream(results), sync_flush=live)
+        if export_format == 'ndjson':
+            return self.generate_ndjson_stream(results)
+        if export_format == 'parquet':
+            return self.generate_parquet_stream(results)
+        raise ValueError(f'Unknown export format: {export_format}')
+
+class ScrapeJob:
+    """バックグラウンドで実行されるバッチジョブ"""
+
+    def __init__(self, user_ids, fresh=False, batch_id=None):
+        self.id = uuid.uuid4().hex
+        self.user_ids = user_ids
+        self.fresh = fresh
+        self.batch_id = batch_id or batch_id_for(user_ids)
+        self.total = len(user_ids)
+        # 結果は完了順に追加し、入力順の番号をpositionsに並べて保持
+        self.results = []
+        self.positions = []
+        self.status_counts = {}
+        self.state = 'queued'
+        self.error = None
+        self.created_at = datetime.now()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        # 結果の追加・完了をストリーミング中の購読者に通知
+        self._changed = threading.Condition(self._lock)
+        self.cancel_event = threading.Event()
+
+    def add_result(self, position, result):
+        """1ユーザー分の結果を記録（positionは入力順の番号）"""
+        with self._lock:
+            self.results.append(result)
+            self.positions.append(position)
+            status = result['status']
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            self._changed.notify_all()
+
+    def finish(self, state, error=None):
+        """終了状態（finished / failed / cancelled）を記録"""
+        with self._lock:
+            self.error = error
+            self.finished_at = datetime.now()
+            self.state = state
+            self._changed.notify_all()
+
+    def cancel(self):
+        """キャンセルを要求（未取得のユーザーは取得しない）"""
+        self.cancel_event.set()
+
+    def cancel_requested(self):
+        return self.cancel_event.is_set()
+
+    def is_finished(self):
+        return self.state in ('finished', 'failed', 'cancelled')
+
+    def wait_for_results(self, start, timeout):
+        """start件目以降の結果が届くか完了するまで待ち、([(入力順の番号, 結果), ...], 完了したか) を返す"""
+        with self._lock:
+            self._changed.wait_for(lambda: len(self.results) > start or self.is_finished(), timeout=timeout)
+            return list(zip(self.positions[start:], self.results[start:])), self.is_finished()
+
+    def ordered_results(self):
+        """結果を入力順に並べて返す（CSV等の出力用）"""
+        with self._lock:
+            entries = sorted(zip(self.positions, self.results), key=lambda entry: entry[0])
+        return [result for _, result in entries]
+
+    def to_dict(self):
+        """進捗情報を辞書で返す"""
+        with self._lock:
+            return {
+                'job_id': self.id,
+                'batch_id': self.batch_id,
+                'state': self.state,
+                'total': self.total,
+                'done': len(self.results),
+                'status_counts': dict(self.status_counts),
+                'error': self.error,
+                'created_at': self.created_at.isoformat(),
+                'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            }
+
+
+class JobManager:
+    """バッチジョブをバックグラウンドのExecutorで実行・管理"""
+
+    def __init__(self, scraper, max_workers=None, max_retained=None):
+        self.scraper = scraper
+        workers = max_workers or int(os.getenv('SCRAPER_JOB_WORKERS', 2))
+        # 完了済みジョブを保持する上限（古いものから破棄）
+        self.max_retained = max_retained or int(os.getenv('SCRAPER_JOB_RETAINED', 100))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, user_ids, fresh=False, batch_id=None):
+        """ジョブを登録して即座に返す"""
+        job = ScrapeJob(user_ids, fresh=fresh, batch_id=batch_id)
+        with self._lock:
+            self.jobs[job.id] = job
+            self._evict()
+        self.executor.submit(self._run, job)
+        logger.info(f"📥 ジョブ登録: {job.id} ({job.total}件)")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """ジョブをキャンセル（見つからなければNone）"""
+        job = self.get(job_id)
+        if job is not None and not job.is_finished():
+            job.cancel()
+            logger.info(f"🛑 ジョブのキャンセルを受け付けました: {job_id}")
+        return job
+
+    def _evict(self):
+        """保持上限を超えた完了済みジョブを古い順に削除"""
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished()]
+        while len(self.jobs) > self.max_retained and finished:
+            del self.jobs[finished.pop(0)]
+
+    def _run(self, job):
+        if job.cancel_requested():
+            job.finish('cancelled')
+            return
+        
+        job.state = 'running'
+        # 遅いユーザーに後続の進捗配信を待たせないよう完了順に受け取る
+        # キャンセル時は結果を待たずに打ち切り、実行中の取得も送信前に止める
+        results = self.scraper.iter_scrape_results_as_completed(
+            job.user_ids, fresh=job.fresh, batch_id=job.batch_id, cancel_event=job.cancel_event
+        )
+        try:
+            for position, result in results:
+                job.add_result(position, result)
+                if job.cancel_requested():
+                    break
+        except Exception as e:
+            job.finish('failed', str(e))
+            logger.error(f"❌ ジョブ失敗: {job.id}: {e}")
+            return
+        finally:
+            # キャンセル時は未着手のユーザーを破棄
+            results.close()
+        
+        if job.cancel_requested() and len(job.results) < job.total:
+            job.finish('cancelled')
+            logger.info(f"🛑 ジョブをキャンセルしました: {job.id} ({len(job.results)}/{job.total}件で停止)")
+        else:
+            job.finish('finished')
+            logger.info(f"✅ ジョブ完了: {job.id} {job.status_counts}")
+
+
+class WatchlistStore:
+    """ウォッチリストと各ユーザーの更新間隔をSQLiteに永続化"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS watchlist ('
+            'user_id TEXT PRIMARY KEY, interval REAL NOT NULL, next_due REAL NOT NULL, '
+            'last_diamond TEXT, last_checked REAL, checks INTEGER NOT NULL DEFAULT 0, '
+            'changes INTEGER NOT NULL DEFAULT 0)'
+        )
+        self._conn.commit()
+
+    def add(self, user_ids, interval):
+        """未登録のユーザーを追加（すぐに取得対象になる）"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO watchlist (user_id, interval, next_due) VALUES (?, ?, ?)',
+                [(user_id, interval, now) for user_id in user_ids]
+            )
+            self._conn.commit()
+
+    def remove(self, user_id):
+        with self._lock:
+            deleted = self._conn.execute('DELETE FROM watchlist WHERE user_id = ?', (user_id,)).rowcount
+            self._conn.commit()
+        return deleted > 0
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM watchlist WHERE user_id = ?', (user_id,)).fetchone()
+        return dict(row) if row else None
+
+    def all(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT * FROM watchlist ORDER BY next_due').fetchall()
+        return [dict(row) for row in rows]
+
+    def update(self, user_id, interval, next_due, last_diamond, changed):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE watchlist SET interval = ?, next_due = ?, last_diamond = ?, last_checked = ?, '
+                'checks = checks + 1, changes = changes + ? WHERE user_id = ?',
+                (interval, next_due, last_diamond, time.time(), int(changed), user_id)
+            )
+            self._conn.commit()
+
+
+class RefreshScheduler:
+    """ウォッチリストを次回予定時刻の優先度キューで巡回し、値の変化頻度に応じて間隔を調整"""
+
+    def __init__(self, scraper, store, budget_per_hour=None, min_interval=None, max_interval=None,
+                 initial_interval=None):
+        self.scraper = scraper
+        self.store = store
+        # 取得回数の上限（回/時）と更新間隔の範囲（秒）
+        self.budget_per_hour = budget_per_hour or float(os.getenv('SCRAPER_WATCH_BUDGET', 600))
+        self.min_interval = min_interval or float(os.getenv('SCRAPER_WATCH_MIN_INTERVAL', 600))
+        self.max_interval = max_interval or float(os.getenv('SCRAPER_WATCH_MAX_INTERVAL', 86400))
+        self.initial_interval = initial_interval or float(os.getenv('SCRAPER_WATCH_INTERVAL', 3600))
+        self.budget = TokenBucketPacer(self.budget_per_hour / 3600)
+        self.executor = ThreadPoolExecutor(max_workers=scraper.max_workers, thread_name_prefix='watch')
+        self._queue = []
+        self._in_flight = set()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        """永続化済みのウォッチリストを読み込んで巡回を開始"""
+        with self._condition:
+            for entry in self.store.all():
+                heapq.heappush(self._queue, (entry['next_due'], entry['user_id']))
+        self._thread = threading.Thread(target=self._loop, name='watch-scheduler', daemon=True)
+        self._thread.start()
+        logger.info(f"⏰ ウォッチリスト巡回開始: {len(self._queue)}件 (上限 {self.budget_per_hour:.0f}回/時)")
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def add(self, user_ids):
+        self.store.add(user_ids, self.initial_interval)
+        now = time.time()
+        with self._condition:
+            for user_id in user_ids:
+                heapq.heappush(self._queue, (now, user_id))
+            self._condition.notify_all()
+
+    def remove(self, user_id):
+        # キュー内の古いエントリは取り出し時に読み飛ばす
+        return self.store.remove(user_id)
+
+    def next_interval(self, entry, result):
+        """値が変化したら間隔を半分に、変化しなければ1.5倍に（範囲内に制限）"""
+        if result['status'] != 'success' or entry['last_diamond'] is None:
+            return entry['interval'], False
+        
+        changed = result['diamond'] != entry['last_diamond']
+        interval = entry['interval'] / 2 if changed else entry['interval'] * 1.5
+        return min(self.max_interval, max(self.min_interval, interval)), changed
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if self._queue and self._queue[0][0] <= time.time():
+                        _, user_id = heapq.heappop(self._queue)
+                        break
+                    timeout = self._queue[0][0] - time.time() if self._queue else None
+                    self._condition.wait(timeout)
+                if self._stopped:
+                    return
+                if user_id in self._in_flight:
+                    continue
+            
+            # 削除済みのユーザーや再登録で重複したエントリは読み飛ばす
+            entry = self.store.get(user_id)
+            if entry is None or entry['next_due'] > time.time():
+                continue
+            
+            with self._condition:
+                self._in_flight.add(user_id)
+            
+            # 全体の取得回数の上限に従う
+            self.budget.acquire()
+            self.executor.submit(self._refresh, user_id, entry)
+
+    def _refresh(self, user_id, entry):
+        try:
+            result = self.scraper.get_profile(user_id, fresh=True)
+            interval, changed = self.next_interval(entry, result)
+            last_diamond = result['diamond'] if result['status'] == 'success' else entry['last_diamond']
+            next_due = time.time() + interval
+            self.store.update(user_id, interval, next_due, last_diamond, changed)
+            logger.info(f"⏰ {user_id}: 次回 {interval / 60:.0f}分後 ({'変化あり' if changed else '変化なし'})")
+        except Exception as e:
+            # 失敗しても巡回から外さず、現在の間隔で再試行
+            next_due = time.time() + entry['interval']
+            logger.error(f"❌ ウォッチリスト更新エラー {user_id}: {e}")
+        finally:
+            with self._condition:
+                self._in_flight.discard(user_id)
+                heapq.heappush(self._queue, (next_due, user_id))
+                self._condition.notify_all()
+
+    def status(self):
+        with self._condition:
+            queued = len(self._queue)
+            in_flight = len(self._in_flight)
+        return {
+            'queued': queued,
+            'in_flight': in_flight,
+            'budget_per_hour': self.budget_per_hour,
+            'min_interval': self.min_interval,
+            'max_interval': self.max_interval,
+        }
+
+
+def create_scheduler(scraper):
+    """SCRAPER_SCHEDULER=1の場合にウォッチリストの巡回を開始"""
+    if os.getenv('SCRAPER_SCHEDULER', '0') != '1':
+        return None
+    store = WatchlistStore(os.getenv('SCRAPER_WATCHLIST_PATH', 'tikleap_watchlist.sqlite3'))
+    scheduler = RefreshScheduler(scraper, store)
+    scheduler.start()
+    return scheduler
+
+
+# Flask アプリケーション
+app = Flask(__name__)
+scraper = TikLeapScraper()
+job_manager = JobManager(scraper)
+scheduler = create_scheduler(scraper)
+
+@app.route('/')
+def home():
+    """Webインターフェース"""
+    return render_template_string(HTML_TEMPLATE)
+
+def health_payload():
+    """ヘルスチェックの応答内容（Flask・ASGIの両方で使用）"""
+    return {
+        'status': 'healthy',
+        'timestamp': datetime.now().isoformat()
+    }
+
+@app.route('/health')
+def health_check():
+    """ヘルスチェック"""
+    return jsonify(health_payload())
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus形式のメトリクス"""
+    return Response(scraper.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats')
+def stats():
+    """接続プール・キャッシュの統計"""
+    return jsonify({
+        'pool': scraper.pool_stats(),
+        'cache': scraper.cache.stats() if scraper.cache is not None else None,
+        'extractors': scraper.extractor.stats(),
+        'controller': scraper.controller.stats(),
+        'archive': scraper.archive.stats() if scraper.archive is not None else None,
+    })
+
+def export_format_error(export_format):
+    """出力形式が使えない場合はエラーレスポンスを返す"""
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unknown format: {export_format}', 'formats': list(EXPORT_FORMATS)}), 400
+    if export_format == 'parquet' and pa is None:
+        return jsonify({'error': 'Parquet export requires pyarrow'}), 501
+    return None
+
+def export_response(results, export_format, filename_stem, headers=None, live=False):
+    """結果を指定形式でストリーミング返却"""
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    return Response(
+        scraper.export_stream(results, export_format, live=live),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename={filename_stem}{extension}',
+            **(headers or {}),
+        }
+    )
+
+@app.route('/scrape', methods=['POST'])
+def scrape():
+    """スクレイピング実行とCSV返却"""
+    try:
+        data = request.json
+        user_ids = [user_id for user_id in map(normalize_user_id, data.get('user_ids', [])) if user_id]
+        
+        if not user_ids:
+            return jsonify({'error': 'No user IDs provided'}), 400
+        
+        # fresh指定時はキャッシュを使わずに再取得
+        fresh = bool(data.get('fresh')) or request.args.get('fresh') == '1'
+        filename_stem = f'tikleap_data_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+        
+        # 出力形式（csv / csv.gz / ndjson / parquet）
+        export_format = data.get('format') or request.args.get('format', 'csv')
+        error = export_format_error(export_format)
+        if error:
+            return error
+        
+        # 同じリストを再送信した場合はチェックポイントから再開
+        batch_id = data.get('batch_id') or batch_id_for(user_ids)
+        
+        # ストリーミングモード：ユーザーごとに完了次第出力を送信
+        stream = data.get('stream') or request.args.get('stream') == '1'
+        if stream:
+            return export_response(
+                scraper.iter_scrape_results(user_ids, fresh=fresh, batch_id=batch_id),
+                export_format,
+                filename_stem,
+                headers={
+                    'X-Batch-Id': batch_id,
+                    # リバースプロキシによるバッファリングを無効化
+                    'X-Accel-Buffering': 'no',
+                },
+                live=True
+            )
+        
+        # スクレイピング実行
+        results = scraper.scrape_multiple_users(user_ids, fresh=fresh, batch_id=batch_id)
+        
+        # ファイルとして返却
+        return export_response(results, export_format, filename_stem, headers={'X-Batch-Id': batch_id})
+        
+    except Exception as e:
+        logger.error(f"❌ エラー: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """バッチジョブを登録してジョブIDを返す"""
+    data = request.get_json(silent=True) or {}
+    user_ids = [user_id for user_id in map(normalize_user_id, data.get('user_ids', [])) if user_id]
+    
+    if not user_ids:
+        return jsonify({'error': 'No user IDs provided'}), 400
+    
+    fresh = bool(data.get('fresh')) or request.args.get('fresh') == '1'
+    job = job_manager.submit(user_ids, fresh=fresh, batch_id=data.get('batch_id'))
+    return jsonify(job.to_dict()), 202
+
+@app.route('/jobs/upload', methods=['POST'])
+def upload_job():
+    """テキスト/CSVファイルのユーザーIDを1行ずつ読み込み、正規化・重複除去してジョブを登録"""
+    # multipartの場合はアップロードファイル、それ以外はリクエスト本文をストリームとして読む
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('file')
+        if upload is None:
+            return jsonify({'error': 'file field is required'}), 400
+        stream = upload.stream
+    else:
+        stream = request.stream
+    
+    user_ids = list(iter_normalized_user_ids(stream))
+    if not user_ids:
+        return jsonify({'error': 'No user IDs provided'}), 400
+    
+    fresh = request.args.get('fresh') == '1'
+    job = job_manager.submit(user_ids, fresh=fresh, batch_id=request.args.get('batch_id'))
+    logger.info(f"📤 アップロードから{len(user_ids)}件のIDを登録")
+    return jsonify(job.to_dict()), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """ジョブの進捗を返す"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """ジョブをキャンセル（ページ離脱時のsendBeaconからも呼べるようPOSTも受け付ける）"""
+    job = job_manager.cancel(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return jsonify(job.to_dict()), 202
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """ジョブの結果をユーザーごとに完了次第Server-Sent Eventsで送信"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    # 再接続時はLast-Event-IDの次から送信（イベントIDは受信順の通し番号、indexは入力順の番号）
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    start = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+    heartbeat = float(os.getenv('SCRAPER_SSE_HEARTBEAT', 15))
+    
+    def events():
+        index = start
+        while True:
+            rows, finished = job.wait_for_results(index, timeout=heartbeat)
+            for position, row in rows:
+                payload = {'index': position, 'done': index + 1, 'total': job.total, 'result': row}
+                yield f"id: {index}\nevent: result\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+                index += 1
+            if finished and not rows:
+                yield f"event: done\ndata: {json.dumps(job.to_dict(), ensure_ascii=False)}\n\n"
+                return
+            if not rows:
+                # 接続維持と切断検知のためのコメント行
+                yield ": keep-alive\n\n"
+    
+    return Response(
+        events(),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # リバースプロキシによるバッファリングを無効化
+            'X-Accel-Buffering': 'no',
+        }
+    )
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+@app.route('/jobs/<job_id>/result.<export_format>', methods=['GET'])
+def get_job_result(job_id, export_format=None):
+    """完了したジョブの結果を返す（result.csv / result.csv.gz / result.ndjson / result.parquet）"""
+    export_format = export_format or request.args.get('format', 'csv')
+    error = export_format_error(export_format)
+    if error:
+        return error
+    
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if not job.is_finished():
+        return jsonify({'error': 'Job is still running', **job.to_dict()}), 409
+    
+    return export_response(job.ordered_results(), export_format, f'tikleap_data_{job.created_at.strftime("%Y%m%d_%H%M%S")}')
+
+@app.route('/api/scrape', methods=['GET'])
+def api_scrape():
+    """API版：単一ユーザースクレイピング"""
     user_id = request.args.get('user_id')
     if not user_id:
         return jsonify({'error': 'user_id parameter is required'}), 400
     
-    result = scraper.scrape_tikleap_profile(user_id)
+    fresh = request.args.get('fresh') == '1'
+    
+    # timing=1の場合は段階ごとの処理時間を付けて返す
+    if request.args.get('timing') == '1':
+        timings = {}
+        result = scraper.get_profile(user_id, fresh=fresh, timings=timings)
+        return jsonify({**result, 'timing': timings})
+    
+    result = scraper.get_profile(user_id, fresh=fresh)
     return jsonify(result)
 
+@app.route('/history/users/<user_id>', methods=['GET'])
+def user_history(user_id):
+    """1ユーザーのdiamond値の履歴"""
+    if scraper.history is None:
+        return jsonify({'error': 'History store is disabled'}), 404
+    
+    since = request.args.get('since', type=float)
+    until = request.args.get('until', type=float)
+    limit = request.args.get('limit', default=1000, type=int)
+    return jsonify({
+        'user_id': user_id,
+        'history': scraper.history.user_history(user_id, since=since, until=until, limit=limit),
+    })
+
+@app.route('/history/latest', methods=['GET'])
+def latest_history():
+    """複数ユーザーの最新値（user_ids=a,b,c）"""
+    if scraper.history is None:
+        return jsonify({'error': 'History store is disabled'}), 404
+    
+    user_ids = [user_id.strip() for user_id in request.args.get('user_ids', '').split(',') if user_id.strip()]
+    if not user_ids:
+        return jsonify({'error': 'user_ids parameter is required'}), 400
+    
+    return jsonify({'latest': scraper.history.latest(user_ids)})
+
+@app.route('/history/movers', methods=['GET'])
+def history_movers():
+    """期間内の変化量が大きいユーザー上位N件（window秒, n件）"""
+    if scraper.history is None:
+        return jsonify({'error': 'History store is disabled'}), 404
+    
+    window = request.args.get('window', default=7 * 86400, type=float)
+    limit = request.args.get('n', default=10, type=int)
+    return jsonify({'window': window, 'movers': scraper.history.top_movers(window, limit=limit)})
+
+@app.route('/watchlist', methods=['GET'])
+def get_watchlist():
+    """ウォッチリストと各ユーザーの更新間隔"""
+    if scheduler is None:
+        return jsonify({'error': 'Scheduler is disabled'}), 404
+    
+    return jsonify({'scheduler': scheduler.status(), 'users': scheduler.store.all()})
+
+@app.route('/watchlist', methods=['POST'])
+def add_watchlist():
+    """ウォッチリストにユーザーを追加"""
+    if scheduler is None:
+        return jsonify({'error': 'Scheduler is disabled'}), 404
+    
+    data = request.get_json(silent=True) or {}
+    user_ids = list(iter_normalized_user_ids(data.get('user_ids', [])))
+    if not user_ids:
+        return jsonify({'error': 'No user IDs provided'}), 400
+    
+    scheduler.add(user_ids)
+    return jsonify({'added': len(user_ids)}), 201
+
+@app.route('/watchlist/<user_id>', methods=['DELETE'])
+def remove_watchlist(user_id):
+    """ウォッチリストからユーザーを削除"""
+    if scheduler is None:
+        return jsonify({'error': 'Scheduler is disabled'}), 404
+    
+    if not scheduler.remove(user_id):
+        return jsonify({'error': 'User not in watchlist'}), 404
+    return jsonify({'removed': user_id})
+
 @app.route('/debug', methods=['GET'])
 def debug_page():
     """デバッグ用：実際のHTMLを確認"""
     user_id = request.args.get('user_id', 'setsu_dayo')
-    url = f"https://www.tikleap.com/profile/{user_id}"
+    url = scraper.profile_url(user_id)
     
     try:
-        session = scraper.create_session()
-        response = session.get(url, timeout=20)
+        response = scraper.session.get(url, headers=scraper.request_headers(), timeout=20)
         
         return f"""
         <h1>Debug Info for {user_id}</h1>
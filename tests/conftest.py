@@ -0,0 +1,9 @@
+# テスト用の設定（main.pyの読み込み時にSQLiteファイルを作らない）
+import os
+import sys
+
+os.environ.setdefault('SCRAPER_CACHE_BACKEND', 'none')
+os.environ.setdefault('SCRAPER_CHECKPOINT_PATH', 'none')
+os.environ.setdefault('SCRAPER_HISTORY_PATH', 'none')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,62 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('12.3K', 12_300),
+    ('12.3 K', 12_300),
+    ('1,234', 1_234),
+    ('2M', 2_000_000),
+    ('1.2万', 12_000),
+    ('1.2万ダイヤ', 12_000),
+    ('5億', 500_000_000),
+    ('1B💎', 1_000_000_000),
+    # 空白の後の語はラベル
+    ('3 months', 3),
+    ('1,234 diamonds', 1_234),
+    ('12.3K coins', 12_300),
+    # 数値に直接続く語は単位（未知ならNone）
+    ('1,234ダイヤ', 1_234),
+    ('3months', None),
+    ('12.3Kg', None),
+    ('', None),
+    (None, None),
+    ('abc', None),
+])
+def test_parse_diamond(value, expected):
+    assert main.parse_diamond(value) == expected
+
+
+def page(body):
+    return f'<html><body><div class="profile">{body}</div></body></html>'.encode('utf-8')
+
+
+@pytest.mark.parametrize('content', [
+    page('<span class="profile-earning-button">1.2K</span>'),
+    page("<span class='label profile-earning-button'> 290.2K </span>"),
+    page('<span class=profile-earning-button>3M</span>'),
+    page('<SPAN CLASS="profile-earning-button">1,234</SPAN >'),
+    page('<span class="profile-earning-button"><b>1.2K</b></span>'),
+    page('<span class="profile-earning-button">&#49;.2K</span>'),
+    page('<span class="profile-earning-button">1.2万</span>'),
+    page('<span class="profile-earning-button"></span><span class="earning-total">5K</span>'),
+    page('<span class="profile-earning-buttons">1.2K</span>'),
+    page('<div data-earning="1">7K</div>'),
+    page('<span class="label">no earnings</span>'),
+    # 閉じタグの名前が異なる場合
+    page('<span class="profile-earning-button">1.2K</spanx>2</span>'),
+    # class属性の重複（最後の値が有効）
+    page('<span class="profile-earning-button" class="x">1.2K</span>'),
+    page('<span class="x" class="profile-earning-button">1.2K</span>'),
+    # 別の属性の値の中にあるclass=
+    page('<span data-x=" class=\'profile-earning-button\'">1.2K</span>'),
+    page('<span data-x=" class=\'profile-earning-button\'" class="label">1.2K</span>'),
+    # html.parserがタグとして解釈しない領域
+    page('<script>var s = \'<span class="profile-earning-button">9K</span>\';</script>'
+         '<span class="profile-earning-button">1.2K</span>'),
+    page('<!-- <span class="profile-earning-button">9K</span> -->'),
+])
+def test_extractor_chain_matches_soup(content):
+    chain = main.ExtractorChain([main.RegexEarningExtractor(), main.SoupEarningExtractor()])
+    assert chain.extract(content) == main.SoupEarningExtractor().extract(content)